@@ -0,0 +1,169 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import sys
+import fcntl
+import signal
+import gobject
+import logging
+
+#------------------------------------------------------------------------------
+# CommandLine
+#------------------------------------------------------------------------------
+class CommandLine:
+    # Argument parsing shared by all programs. Flags start with "-" and may
+    # carry a value (--name=value), anything else is a positional argument.
+    # Every program understands -h, --help and -d, --debug
+    def __init__(self, argv, syntax, notes=None):
+        self.program = argv[0]
+        self.syntax = syntax
+        self.notes = notes or []
+        self.flags = set(filter(lambda x: x.startswith("-"), argv[1:]))
+        self.nonflags = filter(lambda x: not(x.startswith("-")), argv[1:])
+        if self.take_flag("-h", "--help"):
+            self.show_syntax_and_exit()
+        self.logging_level = logging.INFO
+        if self.take_flag("-d", "--debug"):
+            self.logging_level = logging.DEBUG
+
+    def show_syntax_and_exit(self):
+        print "Syntax:"
+        print "  %s -h, --help" % self.program
+        print "  %s [-d, --debug] %s" % (self.program, self.syntax)
+        if len(self.notes) > 0:
+            print
+            for note in self.notes:
+                print note
+        sys.exit(0)
+
+    def take_flag(self, *names):
+        found = False
+        for name in names:
+            if name in self.flags:
+                self.flags.discard(name)
+                found = True
+        return found
+
+    def take_values(self, name):
+        # All the values given as --name=value
+        prefix = name + "="
+        values = []
+        for flag in sorted(filter(lambda x: x.startswith(prefix), self.flags)):
+            self.flags.discard(flag)
+            values.append(flag[len(prefix):])
+        return values
+
+    def take_value(self, name, default=None, value_type=str, choices=None):
+        values = self.take_values(name)
+        if len(values) == 0:
+            return default
+        try:
+            value = value_type(values[-1])
+        except ValueError:
+            self.show_syntax_and_exit()
+        if choices != None and value not in choices:
+            self.show_syntax_and_exit()
+        return value
+
+    def finish(self, max_nonflags=None):
+        # Complain about anything not taken and set up logging
+        if len(self.flags) > 0:
+            self.show_syntax_and_exit()
+        if max_nonflags != None and len(self.nonflags) > max_nonflags:
+            self.show_syntax_and_exit()
+        logging.basicConfig(
+            format = "[%(asctime)s] %(message)s",
+            level = self.logging_level)
+
+def run_main_loop():
+    try:
+        mainloop = gobject.MainLoop()
+        mainloop.run()
+    except KeyboardInterrupt:
+        print
+        print "Exiting"
+
+signal_wakeup_installed = False
+
+def install_signal_wakeup():
+    # Python signal handlers only run along with Python code, which an idle
+    # main loop never executes. The signal number gets written to a pipe
+    # instead, whose watch wakes up the main loop, GLib or Qt alike, and
+    # runs the pending handlers
+    global signal_wakeup_installed
+    if signal_wakeup_installed:
+        return
+    signal_wakeup_installed = True
+    (read_fd, write_fd) = os.pipe()
+    for fd in [ read_fd, write_fd ]:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    signal.set_wakeup_fd(write_fd)
+    def drain(fd, condition):
+        try:
+            while len(os.read(fd, 64)) > 0:
+                pass
+        except OSError:
+            pass # Empty
+        return True
+    gobject.io_add_watch(read_fd, gobject.IO_IN, drain)
+
+#------------------------------------------------------------------------------
+# NameOwnerChanged dispatching
+#------------------------------------------------------------------------------
+name_owner_callback_dict = dict() # (bus, name) -> callbacks
+
+def watch_name_owner(bus, name, callback):
+    # Components hosted in the same process share one NameOwnerChanged
+    # subscription per bus and name. The callback gets the same arguments
+    # as the signal: name, old owner and new owner
+    key = (bus, name)
+    if not name_owner_callback_dict.has_key(key):
+        name_owner_callback_dict[key] = []
+        def dispatch(name, old_owner, new_owner):
+            for registered_callback in list(name_owner_callback_dict[key]):
+                registered_callback(name, old_owner, new_owner)
+        bus.add_signal_receiver(
+            dispatch,
+            dbus_interface="org.freedesktop.DBus",
+            signal_name="NameOwnerChanged",
+            arg0=name)
+    name_owner_callback_dict[key].append(callback)
+
+#------------------------------------------------------------------------------
+# Concurrent requests
+#------------------------------------------------------------------------------
+def gather_replies(requests, callback):
+    # Sends all the asynchronous requests at once, so that they are pipelined
+    # on the connection instead of waiting for each other, and calls back with
+    # the list of replies (in the order of the requests) when all are in.
+    # Every request is a function taking a reply handler, which it must call
+    # exactly once, with None on failure
+    replies = [ None ] * len(requests)
+    pending = [ len(requests) ]
+    def reply_handler(index, reply):
+        replies[index] = reply
+        pending[0] -= 1
+        if pending[0] == 0:
+            callback(replies)
+    if len(requests) == 0:
+        callback(replies)
+        return
+    for (index, request) in enumerate(requests):
+        request(lambda reply, index=index: reply_handler(index, reply))
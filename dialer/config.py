@@ -0,0 +1,190 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import copy
+import signal
+import ConfigParser
+import gobject
+import logging
+from common import install_signal_wakeup
+
+# Tunables shared through one INI file, with a section per program: the
+# modules register their class attributes below, and the file overrides
+# them. The file is validated as a whole and only applied if every value
+# is valid, and it is reloaded on SIGHUP (the file is not watched).
+# Options left out of the file keep the values of the command line or,
+# failing that, of the code
+
+#------------------------------------------------------------------------------
+# Settings
+#------------------------------------------------------------------------------
+class Setting:
+    def __init__(self, section, name, parse, get, set):
+        self.section = section
+        self.name = name
+        self.parse = parse # Raises ValueError on invalid text
+        self.get = get
+        self.set = set
+
+setting_dict = dict() # (section, name) -> Setting
+
+def register(section, owner, attribute, parse, name=None):
+    # Makes an attribute of a class (or module) configurable
+    setting = Setting(section, name or attribute, parse,
+                      lambda: getattr(owner, attribute),
+                      lambda value: setattr(owner, attribute, value))
+    setting_dict[(setting.section, setting.name)] = setting
+
+def register_item(section, name, dictionary, key, parse):
+    # Makes an item of a dictionary configurable
+    setting = Setting(section, name, parse,
+                      lambda: dictionary[key],
+                      lambda value: dictionary.__setitem__(key, value))
+    setting_dict[(section, name)] = setting
+
+def check_range(value, minimum, maximum):
+    if minimum != None and value < minimum:
+        raise ValueError("%s is below %s" % (value, minimum))
+    if maximum != None and value > maximum:
+        raise ValueError("%s is above %s" % (value, maximum))
+    return value
+
+def parse_float(minimum=None, maximum=None):
+    return lambda text: check_range(float(text), minimum, maximum)
+
+def parse_int(minimum=None, maximum=None):
+    return lambda text: check_range(int(text), minimum, maximum)
+
+def parse_choice(choices):
+    def parse(text):
+        if text not in choices:
+            raise ValueError("%s is not one of %s" % (text, ", ".join(choices)))
+        return text
+    return parse
+
+def parse_bool(text):
+    if text.lower() in [ "1", "yes", "true", "on" ]:
+        return True
+    if text.lower() in [ "0", "no", "false", "off" ]:
+        return False
+    raise ValueError("%s is not a boolean" % text)
+
+def parse_string(text):
+    return text
+
+def parse_list(choices=None):
+    # Comma-separated names
+    def parse(text):
+        values = filter(None, map(lambda x: x.strip(), text.split(",")))
+        for value in values:
+            if choices != None and value not in choices:
+                raise ValueError("%s is not one of %s" % (
+                    value, ", ".join(choices)))
+        return values
+    return parse
+
+def parse_module_arguments(text):
+    # PulseAudio module arguments: name=value pairs separated by spaces
+    arguments = dict()
+    for word in text.split():
+        (name, separator, value) = word.partition("=")
+        if separator == "" or not name.replace("_", "").isalnum() or (
+            value == ""):
+            raise ValueError("%s is not a name=value pair" % word)
+        arguments[name] = value
+    return arguments
+
+#------------------------------------------------------------------------------
+# Config
+#------------------------------------------------------------------------------
+class Config:
+    def __init__(self, path):
+        self.path = path
+        # The values before reading the file are restored when an option
+        # is removed from it
+        self.default_dict = dict(map(
+            lambda (key, setting): (key, copy.deepcopy(setting.get())),
+            setting_dict.items()))
+        self.reload()
+        install_signal_wakeup()
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+                      gobject.idle_add(self.reload_requested))
+
+    def reload_requested(self):
+        # Returns false to be used with idle_add
+        logging.info("Reloading %s" % self.path)
+        self.reload()
+        return False
+
+    def read(self):
+        # Returns the values of the file by setting key, raising ValueError
+        # if anything in it is invalid
+        parser = ConfigParser.RawConfigParser()
+        try:
+            if len(parser.read(self.path)) == 0:
+                return dict()
+        except ConfigParser.Error, e:
+            raise ValueError(str(e).strip())
+        known_sections = set(map(lambda (section, name): section,
+                                 setting_dict.keys()))
+        value_dict = dict()
+        for section in parser.sections():
+            if section not in known_sections:
+                # Belongs to one of the other programs
+                logging.debug("Skipping section [%s]" % section)
+                continue
+            for (name, text) in parser.items(section):
+                key = (section, name)
+                if not setting_dict.has_key(key):
+                    raise ValueError("Unknown option %s in [%s]" % (
+                        name, section))
+                try:
+                    value_dict[key] = setting_dict[key].parse(text)
+                except ValueError, e:
+                    raise ValueError("Invalid %s in [%s]: %s" % (
+                        name, section, e))
+        return value_dict
+
+    def reload(self):
+        try:
+            value_dict = self.read()
+        except ValueError, e:
+            logging.error("Ignoring %s: %s" % (self.path, e))
+            return
+        for (key, setting) in sorted(setting_dict.items()):
+            value = value_dict.get(key, self.default_dict[key])
+            if value != setting.get():
+                logging.info("[%s] %s = %s" % (key[0], key[1], value))
+                setting.set(copy.deepcopy(value))
+
+#------------------------------------------------------------------------------
+# Command line
+#------------------------------------------------------------------------------
+default_path = os.path.join(
+    os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")),
+    "opendialer.conf")
+
+command_line_syntax = "[--config=<file>]"
+
+def create_config(command_line):
+    # Takes the config options from the command line. The factory is to be
+    # called after the other options are applied and before the components
+    # are created
+    path = command_line.take_value("--config", default_path)
+    return lambda: Config(path)
@@ -0,0 +1,129 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import threading
+import time
+import logging
+from vcard import VCardReader
+
+# Caller name resolution: contacts are indexed by their normalized numbers,
+# so that the number of a call is resolved with a dictionary lookup. Numbers
+# are normalized to international form without "+" when possible:
+#
+#   +49 89 1234567, 0049 89 1234567 and (with country code 49) 089/1234567
+#   all become 49891234567
+#
+# and numbers that still do not match (unknown country code, numbers sent
+# without prefix by the network...) are looked up by their last digits.
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+def normalize_number(number, country_code=None, international_prefix="00",
+                     national_prefix="0"):
+    number = number.strip()
+    international = number.startswith("+")
+    digits = "".join(filter(lambda c: c.isdigit(), number))
+    if international:
+        return digits
+    if international_prefix and digits.startswith(international_prefix):
+        return digits[len(international_prefix):]
+    if (country_code != None and national_prefix and
+        digits.startswith(national_prefix)):
+        return country_code + digits[len(national_prefix):]
+    return digits
+
+#------------------------------------------------------------------------------
+# ContactIndex
+#------------------------------------------------------------------------------
+class ContactIndex:
+    country_code = None # Country calling code of the phone, like "49"
+    international_prefix = "00"
+    national_prefix = "0"
+    suffix_length = 7 # Trailing digits compared if nothing else matches
+
+    def __init__(self):
+        # Number -> name and suffix -> name (None if several contacts share
+        # it), replaced as a whole, so that lookups need no locking
+        self.index = (dict(), dict())
+        self.loading_thread = None
+        self.reader = None # While loading, to follow the progress
+
+    def normalize(self, number):
+        return normalize_number(
+            number, self.country_code, self.international_prefix,
+            self.national_prefix)
+
+    def build_index(self, contacts):
+        number_dict = dict()
+        suffix_dict = dict()
+        for (name, numbers) in contacts:
+            for number in numbers:
+                normalized = self.normalize(number)
+                if len(normalized) == 0:
+                    continue
+                number_dict.setdefault(normalized, name)
+                if len(normalized) >= self.suffix_length:
+                    suffix = normalized[-self.suffix_length:]
+                    if suffix_dict.get(suffix, name) != name:
+                        suffix_dict[suffix] = None # Ambiguous
+                    else:
+                        suffix_dict[suffix] = name
+        return (number_dict, suffix_dict)
+
+    def load(self, path, contact_callback=None):
+        # The callback gets every contact as it is read
+        start_time = time.time()
+        try:
+            self.reader = VCardReader(open(path))
+            contacts = iter(self.reader)
+            if contact_callback != None:
+                contacts = self.forward_contacts(contacts, contact_callback)
+            index = self.build_index(contacts)
+        except IOError, e:
+            logging.debug("Cannot read contacts: %s" % e)
+            return
+        self.index = index
+        logging.debug("Indexed %d numbers from %s in %.3f s" % (
+            len(index[0]), path, time.time() - start_time))
+
+    def forward_contacts(self, contacts, contact_callback):
+        for contact in contacts:
+            contact_callback(contact)
+            yield contact
+
+    def load_in_background(self, path, loaded_callback=None,
+                           contact_callback=None):
+        # The callbacks are called from the loading thread
+        def load():
+            self.load(path, contact_callback)
+            if loaded_callback != None:
+                loaded_callback()
+        self.loading_thread = threading.Thread(target=load)
+        self.loading_thread.setDaemon(True)
+        self.loading_thread.start()
+
+    def lookup(self, number):
+        # Returns the name of the contact, or None
+        (number_dict, suffix_dict) = self.index
+        normalized = self.normalize(number)
+        if number_dict.has_key(normalized):
+            return number_dict[normalized]
+        if len(normalized) >= self.suffix_length:
+            return suffix_dict.get(normalized[-self.suffix_length:])
+        return None
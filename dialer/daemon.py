@@ -0,0 +1,96 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import sys
+import signal
+import dbus
+import dbus.mainloop.glib
+import logging
+from common import CommandLine, run_main_loop
+import loopbackloader
+import serviceconnector
+import metrics
+import traffic
+import config
+
+# Hosts the loopback-loader and the service-connector in a single process,
+# sharing the main loop, the bus connections and the NameOwnerChanged
+# subscriptions. The dialer GUI keeps running as its own process, since it
+# needs the Qt event loop
+component_names = [ "loopback", "connector" ]
+
+command_line_syntax = (
+    "[--components=loopback,connector] " +
+    loopbackloader.command_line_syntax + " " +
+    serviceconnector.command_line_syntax + " " +
+    metrics.command_line_syntax + " " +
+    traffic.command_line_syntax + " " +
+    config.command_line_syntax + " [<bt-address>...]")
+command_line_notes = [
+    "Runs the given components (all by default) on one main loop.",
+    "The service-connector gets all the addresses, the loopback-loader",
+    "follows the first one. SIGUSR1 logs the status of every component,",
+    "SIGHUP reloads the config file." ]
+
+#------------------------------------------------------------------------------
+# Main
+#------------------------------------------------------------------------------
+def main():
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    # Parse arguments
+    command_line = CommandLine(sys.argv, command_line_syntax, command_line_notes)
+    enabled_names = command_line.take_value(
+        "--components", ",".join(component_names)).split(",")
+    for name in enabled_names:
+        if name not in component_names:
+            command_line.show_syntax_and_exit()
+    device_address = None
+    if len(command_line.nonflags) > 0:
+        device_address = command_line.nonflags[0]
+    # Options of disabled components are still taken, so that the same
+    # command line can be used whatever components are enabled
+    factory_dict = {
+        "loopback": loopbackloader.create_loopback_loader(
+            command_line, device_address),
+        "connector": serviceconnector.create_service_connector(
+            command_line, command_line.nonflags) }
+    metrics_exporter_factory = metrics.create_metrics_exporter(command_line)
+    record_path = command_line.take_value("--record")
+    config_factory = config.create_config(command_line)
+    command_line.finish()
+    traffic.start_recording(record_path)
+    runtime_config = config_factory()
+
+    # Create components
+    components = []
+    for name in component_names:
+        if name in enabled_names:
+            logging.debug("Starting %s" % name)
+            components.append(factory_dict[name]())
+    metrics_exporter = metrics_exporter_factory()
+    def dump_status():
+        for component in components:
+            component.dump_status()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump_status())
+
+    # Run main loop
+    run_main_loop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import sys
+import time
+import collections
+import logging
+
+# Flight recorder: the last events of the process are kept in memory, so
+# that they can be dumped when something goes wrong (on SIGUSR1, on an
+# uncaught exception or when the watchdog sees the main loop stall) even
+# if debug logging was off. Recording an event is one append to a bounded
+# deque: the message is only formatted when dumped, or when debug logging
+# is on, in which case it is also logged right away.
+
+#------------------------------------------------------------------------------
+# FlightRecorder
+#------------------------------------------------------------------------------
+class FlightRecorder:
+    capacity = 4000
+
+    def __init__(self):
+        self.events = collections.deque(maxlen=self.capacity)
+
+    def dump(self, reason):
+        # May be called from any thread: list() copies the deque atomically
+        events = list(self.events)
+        logging.warning("Flight recorder dump (%s), last %d events:" % (
+            reason, len(events)))
+        for (timestamp, message, args) in events:
+            try:
+                text = message % args
+            except (TypeError, ValueError):
+                text = "%s %r" % (message, args)
+            logging.warning("  %s.%03d %s" % (
+                time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                (timestamp % 1) * 1000, text))
+
+recorder = FlightRecorder() # Shared by all components of a process
+
+def trace(message, *args):
+    # Arguments should not be changed afterwards, as they are formatted late
+    recorder.events.append((time.time(), message, args))
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(message, *args)
+
+def install_crash_dump():
+    # Dumps the recorder before any uncaught exception is reported
+    previous_hook = sys.excepthook
+    def excepthook(exception_type, value, traceback):
+        recorder.dump("uncaught %s" % exception_type.__name__)
+        previous_hook(exception_type, value, traceback)
+    sys.excepthook = excepthook
@@ -0,0 +1,204 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import urllib
+import dbus
+import dbus.service
+import gobject
+import logging
+
+# Single instance of the dialer: the running dialer owns a name on the
+# session bus, and any later invocation hands its number (or tel: URI) over
+# to it and exits. This module is imported by the launcher before Qt, so
+# that handing over takes no more than one D-Bus round trip.
+SERVICE_NAME = "org.opendialer.Dialer"
+OBJECT_PATH = "/org/opendialer/Dialer"
+INTERFACE_NAME = "org.opendialer.Dialer"
+forward_timeout = 2.0
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+def parse_number(argument):
+    # Number of a "tel:" URI (RFC 3966) or of a plain argument, without
+    # visual separators; None if there is no number at all
+    if argument.lower().startswith("tel:"):
+        argument = urllib.unquote(argument[4:].split(";")[0])
+    number = "".join(filter(lambda c: c not in " -.()/", argument))
+    if len(number) == 0:
+        return None
+    for char in number:
+        if not(char.isdigit() or char in "+*#pwPW"):
+            return None
+    return number
+
+def get_number_arguments(arguments):
+    # Splits positional arguments into the modem path (which starts with
+    # "/") and the number to dial
+    modem_path = None
+    number = None
+    for argument in filter(lambda a: not a.startswith("-"), arguments):
+        if argument.startswith("/"):
+            modem_path = modem_path or argument
+        else:
+            number = number or parse_number(argument)
+    return (modem_path, number)
+
+def forward_to_running_instance(arguments):
+    # Returns true if a running dialer took over
+    if "-h" in arguments or "--help" in arguments:
+        return False
+    (modem_path, number) = get_number_arguments(arguments)
+    try:
+        # Private, as the shared connection would miss the main loop later
+        bus = dbus.SessionBus(private=True)
+    except dbus.exceptions.DBusException:
+        return False # No session bus, so no single instance either
+    try:
+        if not bus.name_has_owner(SERVICE_NAME):
+            return False
+        dialer = dbus.Interface(
+            bus.get_object(SERVICE_NAME, OBJECT_PATH), INTERFACE_NAME)
+        if number != None:
+            dialer.Dial(number, timeout=forward_timeout)
+        else:
+            dialer.Raise(timeout=forward_timeout)
+        return True
+    except dbus.exceptions.DBusException, e:
+        logging.warning("Running dialer not answering: %s" % e)
+        return False
+    finally:
+        bus.close()
+
+#------------------------------------------------------------------------------
+# DialerService
+#------------------------------------------------------------------------------
+def to_dbus_state(state):
+    # PhoneDialog.get_state() with D-Bus types
+    displays = dbus.Array(map(
+        lambda d: dbus.Dictionary({
+            "Call": dbus.ObjectPath(d["Call"] or "/"),
+            "State": dbus.String(d["State"]),
+            "Number": dbus.String(d["Number"]),
+            "Name": dbus.String(d["Name"]),
+            "Multiparty": dbus.Boolean(d["Multiparty"]) }, signature="sv"),
+        state["Displays"]), signature="a{sv}")
+    return dbus.Dictionary({
+        "State": dbus.String(state["State"]),
+        "Powered": dbus.Boolean(state["Powered"]),
+        "Displays": displays }, signature="sv")
+
+class DialerService(dbus.service.Object):
+    # Exported by the running dialer, forwarding to its PhoneDialog. Actions
+    # do what the buttons do, and displays are numbered from 0 as in
+    # GetState. StateChanged is emitted once per main loop iteration at
+    # most, and only when the state differs from the last one emitted.
+    # The name is owned before the dialog exists, which is set as soon as
+    # it does, before the main loop delivers any call
+    def __init__(self, bus_name):
+        dbus.service.Object.__init__(self, bus_name, OBJECT_PATH)
+        self.bus_name = bus_name # Released when this object dies
+        self.dialog = None
+        self.last_state = None
+        self.state_change_pending = False
+
+    def set_dialog(self, dialog):
+        self.dialog = dialog
+        dialog.state_callbacks.append(self.schedule_state_changed)
+
+    def schedule_state_changed(self):
+        if not self.state_change_pending:
+            self.state_change_pending = True
+            gobject.idle_add(self.emit_state_changed)
+
+    def emit_state_changed(self):
+        # Returns false to be used with idle_add
+        self.state_change_pending = False
+        state = self.dialog.get_state()
+        if state != self.last_state:
+            self.last_state = state
+            self.StateChanged(to_dbus_state(state))
+        return False
+
+    def get_display(self, display_index):
+        if display_index >= len(self.dialog.displays):
+            raise dbus.exceptions.DBusException(
+                "No display %d" % display_index,
+                name=INTERFACE_NAME + ".Error.InvalidArguments")
+        return self.dialog.displays[display_index]
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="s", out_signature="")
+    def Dial(self, number):
+        parsed_number = parse_number(number)
+        if parsed_number == None:
+            raise dbus.exceptions.DBusException(
+                "Not a number: %s" % number,
+                name=INTERFACE_NAME + ".Error.InvalidNumber")
+        logging.debug("Dial requested: %s" % parsed_number)
+        self.dialog.raise_window()
+        self.dialog.dial_number(parsed_number)
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="", out_signature="")
+    def Raise(self):
+        self.dialog.raise_window()
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="", out_signature="")
+    def Answer(self):
+        if not self.dialog.answer():
+            raise dbus.exceptions.DBusException(
+                "No incoming or waiting call",
+                name=INTERFACE_NAME + ".Error.NoCall")
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="u", out_signature="")
+    def Hangup(self, display_index):
+        self.get_display(display_index).do_hangup()
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="", out_signature="")
+    def HangupAll(self):
+        self.dialog.hangup_all_clicked()
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="", out_signature="")
+    def Swap(self):
+        self.dialog.swap()
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="", out_signature="")
+    def CreateMultiparty(self):
+        self.dialog.multiparty_clicked()
+
+    @dbus.service.method(INTERFACE_NAME, in_signature="",
+                         out_signature="a{sv}")
+    def GetState(self):
+        return to_dbus_state(self.dialog.get_state())
+
+    @dbus.service.signal(INTERFACE_NAME, signature="a{sv}")
+    def StateChanged(self, state):
+        pass
+
+def register():
+    # Returns the DialerService, or None if the name could not be owned,
+    # most likely by another dialer, which then gets the arguments. Only
+    # one of several dialers started at once gets the name
+    try:
+        bus_name = dbus.service.BusName(
+            SERVICE_NAME, dbus.SessionBus(), do_not_queue=True)
+    except dbus.exceptions.NameExistsException:
+        return None
+    except dbus.exceptions.DBusException, e:
+        logging.warning("Cannot register %s: %s" % (SERVICE_NAME, e))
+        return None
+    return DialerService(bus_name)
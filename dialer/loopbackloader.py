@@ -0,0 +1,1420 @@
+#!/usr/bin/env python
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import sys
+import os
+import signal
+import subprocess
+import json
+import dbus
+import dbus.mainloop.glib
+import gobject
+import string
+import time
+import logging
+from common import CommandLine, run_main_loop, watch_name_owner, \
+    gather_replies
+import metrics
+import traffic
+import config
+
+property_fetch_histogram = metrics.registry.histogram(
+    "loopback_loader_property_fetch_seconds",
+    "Round trip of PulseAudio property requests",
+    [ 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1 ], "s")
+
+command_line_syntax = (
+    "[--backend=pulseaudio|pipewire|mock] [--latency=<protocol>:<msec>]... "
+    "[--echo-cancel=<protocol>:off|light|webrtc]...")
+
+#------------------------------------------------------------------------------
+# CPU usage
+#------------------------------------------------------------------------------
+def get_process_cpu_time(pid):
+    # User and system time of a process in seconds, None if it is gone
+    if pid == None:
+        return None
+    try:
+        stat_file = open("/proc/%d/stat" % pid)
+        try:
+            # The command name in parentheses may contain spaces
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        finally:
+            stat_file.close()
+        return float(int(fields[11]) + int(fields[12])) / (
+            os.sysconf("SC_CLK_TCK"))
+    except (IOError, IndexError, ValueError):
+        return None
+
+class CpuMeter:
+    # CPU time of the sound server, which runs module-echo-cancel, and of
+    # the process of the loader itself (along with whatever else daemon.py
+    # hosts in it) while call audio runs, by echo cancellation profile.
+    # Comparing the shares of a profile with the ones of "off" tells what
+    # the profile costs on the hardware at hand
+    def __init__(self):
+        self.cpu_counter = metrics.registry.counter(
+            "loopback_loader_sound_server_cpu_seconds_total",
+            "CPU time of the sound server during call audio")
+        self.own_cpu_counter = metrics.registry.counter(
+            "loopback_loader_cpu_seconds_total",
+            "CPU time of the loopback-loader process during call audio")
+        self.duration_counter = metrics.registry.counter(
+            "loopback_loader_call_audio_seconds_total",
+            "Duration of call audio")
+        self.pid = None # Of the sound server
+        self.start_sample = None # (profile, CPU time, own CPU time, time)
+
+    def get_own_cpu_time(self):
+        times = os.times()
+        return times[0] + times[1] # User and system
+
+    def start(self, profile):
+        self.stop()
+        cpu_time = get_process_cpu_time(self.pid)
+        if cpu_time != None:
+            self.start_sample = (profile, cpu_time, self.get_own_cpu_time(),
+                                 time.time())
+
+    def stop(self):
+        if self.start_sample == None:
+            return
+        (profile, start_cpu_time, start_own_cpu_time, start_time) = (
+            self.start_sample)
+        self.start_sample = None
+        cpu_time = get_process_cpu_time(self.pid)
+        if cpu_time == None:
+            return # Server went away meanwhile
+        self.cpu_counter.inc(cpu_time - start_cpu_time, profile=profile)
+        self.own_cpu_counter.inc(
+            self.get_own_cpu_time() - start_own_cpu_time, profile=profile)
+        self.duration_counter.inc(time.time() - start_time, profile=profile)
+
+    def describe(self):
+        shares = []
+        for (key, duration) in sorted(self.duration_counter.value_dict.items()):
+            if duration > 0:
+                labels = dict(key)
+                shares.append(
+                    "%s: sound server %.1f%%, loader %.1f%% over %d s" % (
+                    labels["profile"],
+                    self.cpu_counter.get(**labels) * 100 / duration,
+                    self.own_cpu_counter.get(**labels) * 100 / duration,
+                    duration))
+        return ", ".join(shares) or "not measured"
+
+#------------------------------------------------------------------------------
+# Loopback
+#------------------------------------------------------------------------------
+class Loopback:
+    def __init__(self, source_name, sink_name, protocol, args):
+        self.source_name = source_name
+        self.sink_name = sink_name
+        self.protocol = protocol
+        self.target_latency = int(args.get("latency_msec", 0)) * 1000 # usec
+        self.handle = None # Backend specific, None while loading
+        self.latency_samples = 0
+        self.latency_sum = 0
+        self.latency_min = None
+        self.latency_max = None
+        self.underruns = 0
+        self.overruns = 0
+
+    def key(self):
+        return (self.source_name, self.sink_name)
+
+    def add_latency_sample(self, buffer_latency, other_latency):
+        # Backends do not export xrun counters, so they are derived from the
+        # samples: an empty sink-input buffer means the sink ran dry, and
+        # twice the requested latency means the rate adjustment could not
+        # keep up with a source delivering too much
+        latency = buffer_latency + other_latency
+        self.latency_samples += 1
+        self.latency_sum += latency
+        if self.latency_min == None:
+            self.latency_min = self.latency_max = latency
+        else:
+            self.latency_min = min(latency, self.latency_min)
+            self.latency_max = max(latency, self.latency_max)
+        if buffer_latency == 0:
+            self.underruns += 1
+        elif self.target_latency > 0 and latency > 2 * self.target_latency:
+            self.overruns += 1
+        logging.debug("Loopback %s->%s latency: %.1f ms" % (
+            self.source_name, self.sink_name, latency / 1000.0))
+
+    def describe(self):
+        text = "source='%s' sink='%s' protocol=%s handle=%s" % (
+            self.source_name, self.sink_name, self.protocol,
+            self.handle or "(loading)")
+        if self.latency_samples > 0:
+            text += (" latency avg/min/max=%.1f/%.1f/%.1f ms"
+                     " underruns=%d overruns=%d") % (
+                self.latency_sum / 1000.0 / self.latency_samples,
+                self.latency_min / 1000.0, self.latency_max / 1000.0,
+                self.underruns, self.overruns)
+        return text
+
+    def log_summary(self):
+        if self.latency_samples > 0:
+            logging.info("Loopback finished: %s" % self.describe())
+
+#------------------------------------------------------------------------------
+# AudioBackend
+#------------------------------------------------------------------------------
+class AudioBackend:
+    # Base class of the sound server specific code. A backend reports every
+    # sink and source it sees to its listener (the LoopbackLoader) through
+    # these methods:
+    #
+    #   backend_connected()
+    #   backend_disconnected()
+    #   device_added(device_id, direction, name, protocol, device_string)
+    #   device_removed(device_id)
+    #   default_device_changed(direction, name)
+    #   loopback_removed(handle)
+    #
+    # where direction is either "sink" or "source", and protocol is the
+    # Bluetooth protocol in PulseAudio terms ("sco", "a2dp_source"...) or None
+    # for other devices. All requests are asynchronous.
+    name = None
+
+    def __init__(self):
+        self.listener = None
+
+    def start(self, listener):
+        self.listener = listener
+
+    def is_connected(self):
+        return False
+
+    def load_loopback(self, source_name, sink_name, args,
+                      reply_handler, error_handler):
+        # reply_handler gets the handle of the new loopback
+        error_handler("Loopbacks are not supported by %s" % self.name)
+
+    def unload_loopback(self, handle):
+        pass
+
+    def get_loopback_latency(self, handle, reply_handler):
+        # reply_handler gets (buffer_latency, other_latency) in usec or None
+        reply_handler(None)
+
+    def load_module(self, module_name, args, reply_handler, error_handler):
+        # Any other sound server module, like module-echo-cancel, whose
+        # devices are reported as usual
+        error_handler("%s is not supported by %s" % (module_name, self.name))
+
+    def unload_module(self, handle):
+        pass
+
+    def unload_modules(self, module_names):
+        # Unloads every loaded module with one of these names
+        pass
+
+    def get_server_pid(self, reply_handler):
+        # reply_handler gets the process id of the sound server or None
+        reply_handler(None)
+
+#------------------------------------------------------------------------------
+# PulseAudioBackend
+#------------------------------------------------------------------------------
+class PulseAudioBackend(AudioBackend):
+    name = "pulseaudio"
+    pulseaudio_dbus_name = "org.PulseAudio1"
+
+    def start(self, listener):
+        AudioBackend.start(self, listener)
+        self.invalidate_connection()
+        self.install_general_signal_receivers()
+        try:
+            self.reconnect()
+        except dbus.exceptions.DBusException:
+            pass # PulseAudio might not be running
+
+    def is_connected(self):
+        return self.pa_core != None
+
+    def install_general_signal_receivers(self):
+        watch_name_owner(
+            dbus.SessionBus(), self.pulseaudio_dbus_name,
+            self.name_owner_changed)
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        if name == self.pulseaudio_dbus_name:
+            if new_owner in [ None, "" ]:
+                self.invalidate_connection()
+            else:
+                self.reconnect()
+
+    def reconnect(self):
+        self.invalidate_connection() # Modules of a previous server are gone
+        self.setup_connection()
+        self.install_specific_signal_receivers()
+        self.listener.backend_connected()
+        self.poll_initial_state()
+
+    def setup_connection(self):
+        bus = dbus.SessionBus()
+        # Find out server address
+        server_lookup = bus.get_object(
+            self.pulseaudio_dbus_name,
+            "/org/pulseaudio/server_lookup1")
+        address = server_lookup.Get(
+            "org.PulseAudio.ServerLookup1",
+            "Address",
+            dbus_interface="org.freedesktop.DBus.Properties")
+        # Get core interface
+        connection =  dbus.connection.Connection(address)
+        self.pa_core = dbus.Interface(
+            connection.get_object(
+                object_path="/org/pulseaudio/core1"), "org.PulseAudio.Core1")
+        self.pa_connection = connection
+
+    def invalidate_connection(self):
+        was_connected = (getattr(self, "pa_core", None) != None)
+        self.pa_connection = None
+        self.pa_core = None
+        self.stream_paths_dict = dict() # Module path -> stream paths
+        if was_connected:
+            self.listener.backend_disconnected()
+
+    def install_specific_signal_receivers(self):
+        signal_handlers = [
+            ("NewSink", lambda path: self.new_device(path, "sink")),
+            ("NewSource", lambda path: self.new_device(path, "source")),
+            ("SinkRemoved", self.listener.device_removed),
+            ("SourceRemoved", self.listener.device_removed),
+            ("FallbackSinkUpdated",
+             lambda path: self.fallback_updated(path, "sink")),
+            ("FallbackSourceUpdated",
+             lambda path: self.fallback_updated(path, "source")),
+            ("ModuleRemoved", self.module_removed)
+            ]
+        for (signal_name, handler) in signal_handlers:
+            self.pa_core.ListenForSignal(
+                "org.PulseAudio.Core1." + signal_name,
+                [self.pa_core.proxy_object])
+            self.pa_core.connect_to_signal(signal_name, handler)
+
+    def poll_initial_state(self):
+        # Fallback devices are announced once all devices are known
+        def state_response(replies):
+            (sinks, sources, fallback_sink, fallback_source) = replies
+            for sink in sinks or []:
+                self.new_device(sink, "sink")
+            for source in sources or []:
+                self.new_device(source, "source")
+            if fallback_sink != None:
+                self.fallback_updated(fallback_sink, "sink")
+            if fallback_source != None:
+                self.fallback_updated(fallback_source, "source")
+        gather_replies(
+            map(lambda prop_name: lambda reply:
+                    self.get_core_property(prop_name, reply),
+                [ "Sinks", "Sources", "FallbackSink", "FallbackSource" ]),
+            state_response)
+
+    def fallback_updated(self, device_path, direction):
+        def name_response(name):
+            if name != None:
+                self.listener.default_device_changed(direction, name)
+        self.get_device_property(device_path, "Name", name_response)
+
+    def get_device_property(self, device_path, property_name, reply_handler):
+        self.get_object_property(
+            device_path, "org.PulseAudio.Core1.Device", property_name,
+            reply_handler)
+
+    def get_core_property(self, property_name, reply_handler):
+        self.get_object_property(
+            "/org/pulseaudio/core1", "org.PulseAudio.Core1", property_name,
+            reply_handler)
+
+    def get_object_property(self, object_path, interface_name, property_name,
+                            reply_handler):
+        start_time = time.time()
+        def property_response(value):
+            property_fetch_histogram.add(time.time() - start_time)
+            reply_handler(value)
+        try:
+            properties_interface = dbus.Interface(
+                self.pa_connection.get_object(object_path=object_path),
+                "org.freedesktop.DBus.Properties")
+            properties_interface.Get(
+                interface_name, property_name,
+                reply_handler=property_response,
+                error_handler=lambda e: property_response(None))
+        except dbus.exceptions.DBusException:
+            reply_handler(None)
+
+    def get_from_property_list(self, prop_list, property_name):
+        if prop_list == None or not(prop_list.has_key(property_name)):
+            return None
+        prop = bytearray(prop_list[property_name]).decode("utf-8")
+        return filter(lambda x: x in string.printable, prop)
+
+    def new_device(self, device_path, direction):
+        def device_response(replies):
+            (name, prop_list) = replies
+            if name == None:
+                return
+            protocol = self.get_from_property_list(
+                prop_list, "bluetooth.protocol")
+            device_string = self.get_from_property_list(
+                prop_list, "device.string")
+            self.listener.device_added(
+                device_path, direction, name, protocol, device_string)
+        # Both properties are requested at once
+        gather_replies(
+            map(lambda prop_name: lambda reply:
+                    self.get_device_property(device_path, prop_name, reply),
+                [ "Name", "PropertyList" ]),
+            device_response)
+
+    def module_removed(self, module_path):
+        if self.stream_paths_dict.has_key(module_path):
+            del self.stream_paths_dict[module_path]
+        self.listener.loopback_removed(module_path)
+
+    def load_loopback(self, source_name, sink_name, args,
+                      reply_handler, error_handler):
+        module_args = dict(args)
+        module_args["source"] = source_name
+        module_args["sink"] = sink_name
+        module_args["source_dont_move"] = "1"
+        module_args["sink_dont_move"] = "1"
+        self.load_module(
+            "module-loopback", module_args, reply_handler, error_handler)
+
+    def load_module(self, module_name, args, reply_handler, error_handler):
+        pa_core = self.pa_core
+        def load_response(module_path):
+            if pa_core != self.pa_core:
+                return # Connection lost meanwhile, module died with it
+            reply_handler(module_path)
+        def load_error(error):
+            if pa_core == self.pa_core:
+                error_handler(error)
+        self.pa_core.LoadModule(
+            module_name, args,
+            reply_handler=load_response,
+            error_handler=load_error)
+
+    def unload_loopback(self, module_path):
+        self.unload_module(module_path)
+
+    def unload_module(self, module_path):
+        try:
+            module_interface = dbus.Interface(
+                self.pa_connection.get_object(object_path=module_path),
+                "org.PulseAudio.Core1.Module")
+            module_interface.Unload(
+                reply_handler=lambda: None,
+                error_handler=lambda e: None)
+        except dbus.exceptions.DBusException:
+            pass # Module probably gone already
+
+    def unload_modules(self, module_names):
+        def names_response(module_paths, names):
+            for (module_path, name) in zip(module_paths, names):
+                if name in module_names:
+                    logging.info("Unloading %s" % name)
+                    self.unload_module(module_path)
+        def modules_response(module_paths):
+            module_paths = module_paths or []
+            gather_replies(
+                map(lambda module_path: lambda reply:
+                        self.get_object_property(
+                            module_path, "org.PulseAudio.Core1.Module",
+                            "Name", reply),
+                    module_paths),
+                lambda names: names_response(module_paths, names))
+        self.get_core_property("Modules", modules_response)
+
+    def get_server_pid(self, reply_handler):
+        try:
+            bus = dbus.SessionBus()
+            dbus.Interface(
+                bus.get_object("org.freedesktop.DBus", "/org/freedesktop/DBus"),
+                "org.freedesktop.DBus").GetConnectionUnixProcessID(
+                self.pulseaudio_dbus_name,
+                reply_handler=lambda pid: reply_handler(int(pid)),
+                error_handler=lambda e: reply_handler(None))
+        except dbus.exceptions.DBusException:
+            reply_handler(None)
+
+    def get_loopback_latency(self, module_path, reply_handler):
+        if self.stream_paths_dict.has_key(module_path):
+            self.get_stream_latency(module_path, reply_handler)
+        else:
+            self.find_loopback_streams(module_path, reply_handler)
+
+    def find_loopback_streams(self, module_path, reply_handler):
+        # The sink-input and the source-output are owned by the module
+        def owners_response(streams, owner_paths):
+            found_paths = dict()
+            for ((stream_type, stream_path), owner_path) in zip(streams,
+                                                                owner_paths):
+                if owner_path == module_path:
+                    found_paths[stream_type] = stream_path
+            if len(found_paths) == 2:
+                self.stream_paths_dict[module_path] = (
+                    found_paths["playback"], found_paths["record"])
+                self.get_stream_latency(module_path, reply_handler)
+        def streams_response(replies):
+            (playback_paths, record_paths) = replies
+            streams = (
+                map(lambda p: ("playback", p), playback_paths or []) +
+                map(lambda p: ("record", p), record_paths or []))
+            gather_replies(
+                map(lambda (stream_type, stream_path): lambda reply:
+                        self.get_object_property(
+                            stream_path, "org.PulseAudio.Core1.Stream",
+                            "OwnerModule", reply),
+                    streams),
+                lambda owner_paths: owners_response(streams, owner_paths))
+        gather_replies(
+            map(lambda prop_name: lambda reply:
+                    self.get_core_property(prop_name, reply),
+                [ "PlaybackStreams", "RecordStreams" ]),
+            streams_response)
+
+    def get_stream_latency(self, module_path, reply_handler):
+        # Latencies are reported in usec: buffered in the stream itself and
+        # pending in the device it is attached to
+        def latency_response(latencies):
+            if None in latencies:
+                # Look up the streams again next time
+                self.stream_paths_dict.pop(module_path, None)
+                return
+            (playback_buffer, playback_device, record_buffer,
+             record_device) = map(int, latencies)
+            reply_handler((playback_buffer,
+                           playback_device + record_buffer + record_device))
+        (playback_path, record_path) = self.stream_paths_dict[module_path]
+        requests = []
+        for stream_path in [ playback_path, record_path ]:
+            for prop_name in [ "BufferLatency", "DeviceLatency" ]:
+                requests.append(
+                    lambda reply, stream_path=stream_path,
+                        prop_name=prop_name:
+                        self.get_object_property(
+                            stream_path, "org.PulseAudio.Core1.Stream",
+                            prop_name, reply))
+        gather_replies(requests, latency_response)
+
+#------------------------------------------------------------------------------
+# PipeWireBackend
+#------------------------------------------------------------------------------
+class PipeWireBackend(AudioBackend):
+    # PipeWire has no D-Bus interface, so the graph is followed through
+    # pw-dump in monitor mode, and loopbacks are plain links between the
+    # ports of both nodes (no extra buffering or resampling module)
+    name = "pipewire"
+    dump_command = [ "pw-dump", "--monitor", "--no-colors" ]
+    link_command = [ "pw-link" ]
+    restart_delay = 2.0
+    # PipeWire profile names to PulseAudio protocol names
+    protocol_dict = {
+        "headset-head-unit": "sco",
+        "headset-audio-gateway": "hsp",
+        "a2dp-source": "a2dp_source",
+        "a2dp-sink": "a2dp_sink" }
+
+    def start(self, listener):
+        AudioBackend.start(self, listener)
+        self.dump_process = None
+        self.invalidate_graph()
+        self.start_monitor()
+
+    def is_connected(self):
+        return self.dump_process != None
+
+    def invalidate_graph(self):
+        self.node_dict = dict() # Node id -> (direction, name)
+        self.default_dict = dict() # Direction -> name
+        self.quantum = None
+        self.rate = None
+        self.dump_buffer = ""
+        self.dump_lines = []
+
+    def start_monitor(self):
+        # Returns false to be used with timeout_add
+        try:
+            self.dump_process = subprocess.Popen(
+                self.dump_command, stdout=subprocess.PIPE)
+        except OSError, e:
+            logging.warning("Cannot run %s: %s" % (self.dump_command[0], e))
+            self.dump_process = None
+            gobject.timeout_add(
+                int(self.restart_delay * 1000), self.start_monitor)
+            return False
+        gobject.io_add_watch(
+            self.dump_process.stdout, gobject.IO_IN | gobject.IO_HUP,
+            self.dump_output)
+        self.listener.backend_connected()
+        return False
+
+    def dump_output(self, source, condition):
+        data = ""
+        if condition & gobject.IO_IN:
+            data = os.read(source.fileno(), 65536)
+        if data == "":
+            # PipeWire went away (or restarts), so start from scratch
+            self.dump_process.wait()
+            self.dump_process = None
+            self.invalidate_graph()
+            self.listener.backend_disconnected()
+            gobject.timeout_add(
+                int(self.restart_delay * 1000), self.start_monitor)
+            return False
+        self.dump_buffer += data
+        while "\n" in self.dump_buffer:
+            (line, self.dump_buffer) = self.dump_buffer.split("\n", 1)
+            self.dump_lines.append(line)
+            if line == "]": # Each update is a complete top-level JSON array
+                try:
+                    objects = json.loads("\n".join(self.dump_lines))
+                except ValueError:
+                    objects = []
+                self.dump_lines = []
+                for pw_object in objects:
+                    self.process_object(pw_object)
+        return True
+
+    def process_object(self, pw_object):
+        object_id = pw_object.get("id")
+        info = pw_object.get("info")
+        if pw_object.get("type") == "PipeWire:Interface:Metadata":
+            self.process_metadata(pw_object)
+            return
+        if info == None:
+            # Object removed
+            if self.node_dict.has_key(object_id):
+                del self.node_dict[object_id]
+                self.listener.device_removed(object_id)
+            return
+        if pw_object.get("type") != "PipeWire:Interface:Node":
+            return
+        props = info.get("props", dict())
+        media_class = props.get("media.class")
+        if media_class == "Audio/Sink":
+            direction = "sink"
+        elif media_class == "Audio/Source":
+            direction = "source"
+        else:
+            return
+        if self.node_dict.has_key(object_id):
+            return # Already known, only its state changed
+        name = props.get("node.name")
+        protocol = None
+        device_string = None
+        if props.get("device.api") == "bluez5":
+            protocol = self.protocol_dict.get(props.get("api.bluez5.profile"))
+            device_string = props.get("api.bluez5.address")
+        self.node_dict[object_id] = (direction, name)
+        self.listener.device_added(
+            object_id, direction, name, protocol, device_string)
+
+    def process_metadata(self, pw_object):
+        for entry in pw_object.get("metadata") or []:
+            key = entry.get("key")
+            value = entry.get("value")
+            if isinstance(value, basestring):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            if isinstance(value, dict):
+                value = value.get("name", value.get("value"))
+            if key == "default.audio.sink" and value != None:
+                self.default_dict["sink"] = value
+                self.listener.default_device_changed("sink", value)
+            elif key == "default.audio.source" and value != None:
+                self.default_dict["source"] = value
+                self.listener.default_device_changed("source", value)
+            elif key in [ "clock.quantum", "clock.force-quantum" ]:
+                if value:
+                    self.quantum = int(value)
+            elif key in [ "clock.rate", "clock.force-rate" ]:
+                if value:
+                    self.rate = int(value)
+
+    def run_link_command(self, args, reply_handler, error_handler):
+        try:
+            process = subprocess.Popen(self.link_command + args)
+        except OSError, e:
+            error_handler(e)
+            return
+        def child_exited(pid, status):
+            if status == 0:
+                reply_handler()
+            else:
+                error_handler("%s exited with %d" % (
+                    self.link_command[0], status))
+        gobject.child_watch_add(process.pid, child_exited)
+
+    def load_loopback(self, source_name, sink_name, args,
+                      reply_handler, error_handler):
+        # Latency arguments do not apply: a link adds no buffering on top of
+        # the graph quantum
+        handle = (source_name, sink_name)
+        self.run_link_command(
+            [ source_name, sink_name ],
+            lambda: reply_handler(handle), error_handler)
+
+    def unload_loopback(self, handle):
+        self.run_link_command(
+            [ "-d" ] + list(handle), lambda: None, lambda e: None)
+
+    def load_module(self, module_name, args, reply_handler, error_handler):
+        # Echo cancellation is a filter-chain of the PipeWire configuration,
+        # which cannot be set up at runtime
+        logging.warning("%s is not supported by %s" % (module_name, self.name))
+        AudioBackend.load_module(
+            self, module_name, args, reply_handler, error_handler)
+
+    def unload_modules(self, module_names):
+        logging.debug("No modules to unload with %s" % self.name)
+
+    def get_loopback_latency(self, handle, reply_handler):
+        if self.quantum == None or not self.rate:
+            reply_handler(None)
+            return
+        # Linked ports exchange one quantum per graph cycle
+        reply_handler((self.quantum * 1000000 / self.rate, 0))
+
+#------------------------------------------------------------------------------
+# MockBackend
+#------------------------------------------------------------------------------
+class MockBackend(AudioBackend):
+    # In-memory backend without any sound server, replying synchronously.
+    # The graph is changed through add_device(), remove_device() and
+    # set_default(), and loaded loopbacks can be inspected in loopback_dict.
+    # Echo cancellation modules add their sink and source like PulseAudio
+    name = "mock"
+
+    def start(self, listener):
+        AudioBackend.start(self, listener)
+        self.loopback_dict = dict() # Handle -> (source, sink, args)
+        self.module_dict = dict() # Handle -> (module name, args, device ids)
+        self.unloaded_module_names = []
+        self.next_id = 0
+        self.fail_loads = False
+        self.latency = None
+        self.listener.backend_connected()
+
+    def is_connected(self):
+        return True
+
+    def add_device(self, direction, name, protocol=None, device_string=None):
+        self.next_id += 1
+        device_id = "device%d" % self.next_id
+        self.listener.device_added(
+            device_id, direction, name, protocol, device_string)
+        return device_id
+
+    def remove_device(self, device_id):
+        self.listener.device_removed(device_id)
+
+    def set_default(self, direction, name):
+        self.listener.default_device_changed(direction, name)
+
+    def load_loopback(self, source_name, sink_name, args,
+                      reply_handler, error_handler):
+        if self.fail_loads:
+            error_handler("Mock failure")
+            return
+        self.next_id += 1
+        handle = "loopback%d" % self.next_id
+        self.loopback_dict[handle] = (source_name, sink_name, dict(args))
+        reply_handler(handle)
+
+    def unload_loopback(self, handle):
+        if self.loopback_dict.has_key(handle):
+            del self.loopback_dict[handle]
+
+    def get_loopback_latency(self, handle, reply_handler):
+        reply_handler(self.latency)
+
+    def load_module(self, module_name, args, reply_handler, error_handler):
+        if self.fail_loads:
+            error_handler("Mock failure")
+            return
+        device_ids = []
+        if module_name == "module-echo-cancel":
+            device_ids = [ self.add_device("sink", args["sink_name"]),
+                           self.add_device("source", args["source_name"]) ]
+        self.next_id += 1
+        handle = "module%d" % self.next_id
+        self.module_dict[handle] = (module_name, dict(args), device_ids)
+        reply_handler(handle)
+
+    def unload_module(self, handle):
+        if self.module_dict.has_key(handle):
+            (module_name, args, device_ids) = self.module_dict.pop(handle)
+            for device_id in device_ids:
+                self.remove_device(device_id)
+
+    def unload_modules(self, module_names):
+        self.unloaded_module_names += module_names
+
+    def get_server_pid(self, reply_handler):
+        reply_handler(os.getpid())
+
+#------------------------------------------------------------------------------
+# ReplayBackend
+#------------------------------------------------------------------------------
+class ReplayBackend(AudioBackend):
+    # Answers the requests of the LoopbackLoader with the replies of a
+    # traffic capture, delivered by the replay dispatcher. Latency replies
+    # may come before the request, as the sampling timer does not follow
+    # the recorded timing
+    name = "replay"
+
+    def start(self, listener):
+        AudioBackend.start(self, listener)
+        self.load_handler_dict = dict() # (source, sink) -> handlers
+        self.latency_handler_dict = dict() # Handle -> reply handler
+        self.latency_dict = dict() # Handle -> early latency reply
+        self.module_handler_dict = dict() # Module name -> handlers
+
+    def is_connected(self):
+        return True
+
+    def load_loopback(self, source_name, sink_name, args,
+                      reply_handler, error_handler):
+        self.load_handler_dict[(source_name, sink_name)] = (
+            reply_handler, error_handler)
+
+    def unload_loopback(self, handle):
+        pass # The capture tells whether it got removed
+
+    def get_loopback_latency(self, handle, reply_handler):
+        if self.latency_dict.has_key(handle):
+            reply_handler(self.latency_dict.pop(handle))
+        else:
+            self.latency_handler_dict[handle] = reply_handler
+
+    def load_module(self, module_name, args, reply_handler, error_handler):
+        self.module_handler_dict[module_name] = (reply_handler, error_handler)
+
+    def deliver_module_reply(self, module_name, handle, error=None):
+        handlers = self.module_handler_dict.pop(module_name, None)
+        if handlers == None:
+            logging.warning("Module %s was not requested" % module_name)
+        elif error == None:
+            handlers[0](handle)
+        else:
+            handlers[1](error)
+
+    def deliver_load_reply(self, source_name, sink_name, handle, error=None):
+        handlers = self.load_handler_dict.pop((source_name, sink_name), None)
+        if handlers == None:
+            logging.warning("Loopback %s -> %s was not requested" % (
+                source_name, sink_name))
+        elif error == None:
+            handlers[0](handle)
+        else:
+            handlers[1](error)
+
+    def deliver_latency_reply(self, handle, latency):
+        reply_handler = self.latency_handler_dict.pop(handle, None)
+        if reply_handler != None:
+            reply_handler(latency)
+        else:
+            self.latency_dict[handle] = latency
+
+#------------------------------------------------------------------------------
+# CallStateMonitor
+#------------------------------------------------------------------------------
+class CallStateMonitor:
+    # Follows the oFono voice calls, the same way PhoneDialog does, and tells
+    # the listener when call audio is needed: from the moment a call becomes
+    # active or alerting until the last call disconnects
+    audio_call_states = [ "active", "alerting" ]
+
+    def __init__(self, device_address, listener):
+        self.device_address = device_address # Can be None
+        self.listener = listener
+        self.modem_serial_dict = dict() # Modem path -> serial
+        self.call_dict = dict() # Call path -> state
+        self.in_call = False
+        self.install_signal_receivers()
+        self.poll_modems()
+
+    def install_signal_receivers(self):
+        bus = dbus.SystemBus()
+        watch_name_owner(bus, "org.ofono", self.name_owner_changed)
+        bus.add_signal_receiver(
+            self.modem_added,
+            dbus_interface="org.ofono.Manager",
+            signal_name="ModemAdded")
+        bus.add_signal_receiver(
+            self.modem_removed,
+            dbus_interface="org.ofono.Manager",
+            signal_name="ModemRemoved")
+        bus.add_signal_receiver(
+            self.call_added,
+            dbus_interface="org.ofono.VoiceCallManager",
+            signal_name="CallAdded")
+        bus.add_signal_receiver(
+            self.call_removed,
+            dbus_interface="org.ofono.VoiceCallManager",
+            signal_name="CallRemoved")
+        bus.add_signal_receiver(
+            self.call_property_changed,
+            dbus_interface="org.ofono.VoiceCall",
+            signal_name="PropertyChanged",
+            path_keyword="call_path")
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        self.modem_serial_dict = dict()
+        self.call_dict = dict()
+        self.update_in_call()
+        if new_owner not in [ None, "" ]:
+            self.poll_modems()
+
+    def poll_modems(self):
+        def modems_response(modems):
+            for (modem_path, properties) in modems:
+                self.modem_added(modem_path, properties)
+        try:
+            manager = dbus.Interface(
+                dbus.SystemBus().get_object("org.ofono", "/"),
+                "org.ofono.Manager")
+            manager.GetModems(
+                reply_handler=modems_response,
+                error_handler=lambda e: None)
+        except dbus.exceptions.DBusException:
+            pass # oFono might not be running
+
+    def modem_added(self, modem_path, properties):
+        serial = properties.get("Serial")
+        if self.device_address not in [ None, serial ]:
+            return # Some other phone
+        self.modem_serial_dict[modem_path] = serial
+        def calls_response(calls):
+            for (call_path, call_properties) in calls:
+                self.call_added(call_path, call_properties)
+        try:
+            voicecallmanager_interface = dbus.Interface(
+                dbus.SystemBus().get_object("org.ofono", modem_path),
+                "org.ofono.VoiceCallManager")
+            voicecallmanager_interface.GetCalls(
+                reply_handler=calls_response,
+                error_handler=lambda e: None)
+        except dbus.exceptions.DBusException:
+            pass # Modem probably not powered
+
+    def modem_removed(self, modem_path):
+        if self.modem_serial_dict.has_key(modem_path):
+            del self.modem_serial_dict[modem_path]
+            for call_path in self.call_dict.keys():
+                if call_path.startswith(modem_path + "/"):
+                    del self.call_dict[call_path]
+            self.update_in_call()
+
+    def is_own_call(self, call_path):
+        modem_path = call_path[:call_path.rindex("/")]
+        return self.modem_serial_dict.has_key(modem_path)
+
+    def call_added(self, call_path, properties):
+        if self.is_own_call(call_path):
+            self.call_dict[call_path] = properties.get("State", "disconnected")
+            self.update_in_call()
+
+    def call_removed(self, call_path):
+        if self.call_dict.has_key(call_path):
+            del self.call_dict[call_path]
+            self.update_in_call()
+
+    def call_property_changed(self, property_name, property_value, call_path):
+        if property_name == "State" and self.call_dict.has_key(call_path):
+            self.call_dict[call_path] = property_value
+            self.update_in_call()
+
+    def update_in_call(self):
+        states = set(self.call_dict.values())
+        states.discard("disconnected")
+        if len(states) == 0:
+            in_call = False # Last call disconnected
+        elif len(states & set(self.audio_call_states)) > 0:
+            in_call = True
+        else:
+            in_call = self.in_call # Ringing, or just held
+        if in_call != self.in_call:
+            self.in_call = in_call
+            self.listener.call_state_changed(in_call)
+
+#------------------------------------------------------------------------------
+# LoopbackLoader
+#------------------------------------------------------------------------------
+class LoopbackLoader:
+    # Routing logic: every Bluetooth source is looped back to the fallback
+    # sink, and the fallback source to every Bluetooth sink
+    unwanted_modules = [ "module-suspend-on-idle" ]
+    enabled_protocols = [ "hsp", "sco", "a2dp_source" ]
+    # Additional module-loopback arguments for each protocol: narrowband
+    # speech wants the lowest delay that does not drop out, while music
+    # playback can afford a bigger buffer
+    latency_profiles = {
+        "hsp":         { "latency_msec": "40",  "adjust_time": "2" },
+        "sco":         { "latency_msec": "40",  "adjust_time": "2" },
+        "a2dp_source": { "latency_msec": "200", "adjust_time": "10" } }
+    latency_sample_interval = 5.0
+    echo_cancel_suffix = ".echo-cancel"
+    # Echo cancellation of call audio: unless there are echo cancelling
+    # devices already, module-echo-cancel is loaded on top of the fallback
+    # devices while a call needs audio, with the profile of the protocol of
+    # the call. Speex is cheap, WebRTC cancels better at several times the
+    # CPU time, which hardly matters for narrowband SCO
+    echo_cancel_profiles = {
+        "light":  { "aec_method": "speex",
+                    "aec_args": "agc=0 denoise=0 dereverb=0" },
+        "webrtc": { "aec_method": "webrtc",
+                    "aec_args": "analog_gain_control=0 "
+                                "digital_gain_control=1 noise_suppression=1" } }
+    echo_cancel_protocol_profiles = { "hsp": "off", "sco": "off" }
+    echo_cancel_device_names = {
+        "sink": "opendialer_sink" + echo_cancel_suffix,
+        "source": "opendialer_source" + echo_cancel_suffix }
+    # Call audio waits that long at most for the echo cancelling devices
+    echo_cancel_ready_timeout = 1.0
+    # Protocols only routed while a call needs audio
+    call_driven_protocols = [ "hsp", "sco" ]
+    # Delay between call start and call audio that starts to be noticeable
+    call_setup_latency_threshold = 0.15
+
+    def __init__(self, device_address, backend, monitor_calls=True):
+        self.device_address = device_address # Can be None
+        self.backend = backend
+        self.in_call = False
+        self.call_start_time = None
+        self.call_setup_histogram = metrics.registry.histogram(
+            "loopback_loader_call_audio_setup_seconds",
+            "Time from call start until its audio loopback was loaded",
+            [ 0.05, 0.1, 0.15, 0.2, 0.5, 1, 2, 5 ], "s")
+        metrics.registry.gauge(
+            "loopback_loader_loaded_loopbacks",
+            "Loopbacks currently loaded").set_function(
+            lambda: len(filter(lambda l: l.handle != None,
+                               self.loopback_dict.values())))
+        self.cpu_meter = CpuMeter()
+        self.reset_state()
+        traffic.record("loopback", "start", device_address)
+        listener = traffic.wrap_listener("loopback", self)
+        self.backend.start(listener)
+        self.call_state_monitor = None
+        if monitor_calls and len(self.call_driven_protocols) > 0:
+            self.call_state_monitor = CallStateMonitor(
+                device_address, listener)
+
+    def reset_state(self):
+        self.default_dict = dict() # Direction -> device name
+        self.echo_cancel_dict = dict() # Direction -> device name
+        self.device_dict = dict() # Device id -> (direction, name)
+        self.bluetooth_device_dict = dict() # Device id -> Bluetooth device
+        self.loopback_dict = dict() # (source, sink) -> Loopback
+        self.echo_cancel_request = None # Profile of the module (re)quested
+        self.echo_cancel_handle = None
+        self.echo_cancel_pending = False # Call audio waits for its devices
+        self.echo_cancel_failed = False # Not retried until the call ends
+
+    def backend_connected(self):
+        logging.debug("Connected to %s" % self.backend.name)
+        self.reset_state()
+        if len(self.unwanted_modules) > 0:
+            self.backend.unload_modules(self.unwanted_modules)
+        # The module died with the server if it restarted during a call
+        self.update_echo_cancel()
+        def pid_response(pid):
+            self.cpu_meter.pid = pid
+            if self.in_call:
+                self.cpu_meter.start(self.get_echo_cancel_profile())
+        self.backend.get_server_pid(pid_response)
+
+    def backend_disconnected(self):
+        logging.debug("Disconnected from %s" % self.backend.name)
+        self.cpu_meter.stop()
+        self.cpu_meter.pid = None
+        for loopback in self.loopback_dict.values():
+            loopback.log_summary()
+        self.reset_state() # Loopbacks died with the server
+
+    def get_fallback(self, direction, protocol=None):
+        # Call audio goes through the echo cancellation devices while they
+        # exist, anything else (music) through the default devices
+        if (protocol in self.call_driven_protocols and
+            self.echo_cancel_dict.has_key(direction)):
+            return self.echo_cancel_dict[direction]
+        return self.default_dict.get(direction)
+
+    def default_device_changed(self, direction, name):
+        logging.debug("Default %s: %s" % (direction, name))
+        self.default_dict[direction] = name
+        self.update_echo_cancel()
+        self.update_routes()
+
+    def device_added(self, device_id, direction, name, protocol,
+                     device_string):
+        self.device_dict[device_id] = (direction, name)
+        if name.endswith(self.echo_cancel_suffix):
+            logging.warning(
+                "Using echo cancellation %s: %s" % (direction, name))
+            self.echo_cancel_dict[direction] = name
+            if len(self.echo_cancel_dict) == 2:
+                self.echo_cancel_pending = False
+            self.update_routes()
+            return
+        if protocol not in self.enabled_protocols:
+            return
+        if self.device_address not in [ None, device_string ]:
+            return
+        logging.debug("New %s: %s; protocol: %s" % (direction, name, protocol))
+        self.bluetooth_device_dict[device_id] = (direction, name, protocol)
+        self.update_echo_cancel()
+        self.update_routes()
+
+    def device_removed(self, device_id):
+        if not self.device_dict.has_key(device_id):
+            return
+        (direction, name) = self.device_dict.pop(device_id)
+        if self.echo_cancel_dict.get(direction) == name:
+            del self.echo_cancel_dict[direction]
+        if self.bluetooth_device_dict.has_key(device_id):
+            logging.debug("Bluetooth %s removed: %s" % (direction, name))
+            del self.bluetooth_device_dict[device_id]
+        self.update_routes()
+
+    def loopback_removed(self, handle):
+        # Forget loopbacks removed by someone else (or by ourselves)
+        for (key, loopback) in self.loopback_dict.items():
+            if loopback.handle == handle:
+                del self.loopback_dict[key]
+                loopback.log_summary()
+
+    def call_state_changed(self, in_call):
+        logging.debug("Call audio %s" % ("needed" if in_call else "released"))
+        self.in_call = in_call
+        if in_call:
+            self.call_start_time = time.time()
+            self.update_echo_cancel()
+            self.cpu_meter.start(self.get_echo_cancel_profile())
+        else:
+            self.call_start_time = None
+            self.cpu_meter.stop()
+            self.stop_echo_cancel()
+        self.update_routes()
+
+    def get_echo_cancel_profile(self):
+        # The profile in effect, for the CPU usage
+        if self.echo_cancel_request != None:
+            return self.echo_cancel_request
+        if len(self.echo_cancel_dict) > 0:
+            return "external"
+        return "off"
+
+    def update_echo_cancel(self):
+        # Echo cancellation is loaded as soon as the call has the devices it
+        # needs, which are reported anew when the sound server restarted
+        if self.in_call and self.echo_cancel_request == None and not (
+            self.echo_cancel_failed):
+            self.start_echo_cancel()
+
+    def start_echo_cancel(self):
+        profile = "off"
+        for (direction, name, protocol) in sorted(
+            self.bluetooth_device_dict.values()):
+            if protocol in self.call_driven_protocols:
+                profile = self.echo_cancel_protocol_profiles.get(
+                    protocol, "off")
+                break
+        if not self.echo_cancel_profiles.has_key(profile):
+            return
+        if len(self.echo_cancel_dict) > 0:
+            return # Set up by someone else
+        (source_name, sink_name) = (
+            self.default_dict.get("source"), self.default_dict.get("sink"))
+        if None in [ source_name, sink_name ]:
+            return
+        args = dict(self.echo_cancel_profiles[profile])
+        args["source_master"] = source_name
+        args["sink_master"] = sink_name
+        args["source_name"] = self.echo_cancel_device_names["source"]
+        args["sink_name"] = self.echo_cancel_device_names["sink"]
+        logging.debug("Loading %s echo cancellation" % profile)
+        self.echo_cancel_request = profile
+        self.echo_cancel_pending = True
+        def load_response(handle):
+            if self.echo_cancel_request != profile:
+                # Call ended meanwhile
+                self.backend.unload_module(handle)
+                return
+            self.echo_cancel_handle = handle
+        def load_error(error):
+            logging.warning("Failed to load echo cancellation: %s" % error)
+            if self.echo_cancel_request == profile:
+                self.echo_cancel_request = None
+                self.echo_cancel_failed = True
+                self.echo_cancel_pending = False
+                self.update_routes()
+        def ready_timeout():
+            # Returns false to be used with timeout_add
+            if self.echo_cancel_request == profile and (
+                self.echo_cancel_pending):
+                logging.warning("Echo cancellation not ready, not waiting")
+                self.echo_cancel_pending = False
+                self.update_routes()
+            return False
+        gobject.timeout_add(
+            int(self.echo_cancel_ready_timeout * 1000), ready_timeout)
+        self.backend.load_module(
+            "module-echo-cancel", args,
+            traffic.wrap_handler(
+                "loopback", "module_reply", load_response,
+                "module-echo-cancel"),
+            traffic.wrap_handler(
+                "loopback", "module_error", load_error, "module-echo-cancel"))
+
+    def stop_echo_cancel(self):
+        self.echo_cancel_failed = False
+        if self.echo_cancel_request == None:
+            return
+        logging.debug("Unloading echo cancellation")
+        self.echo_cancel_request = None
+        self.echo_cancel_pending = False
+        if self.echo_cancel_handle != None:
+            self.backend.unload_module(self.echo_cancel_handle)
+            self.echo_cancel_handle = None
+
+    def get_wanted_loopbacks(self):
+        wanted_dict = dict() # (source, sink) -> protocol
+        for (direction, name, protocol) in self.bluetooth_device_dict.values():
+            if protocol in self.call_driven_protocols and (
+                not self.in_call or self.echo_cancel_pending):
+                continue
+            if direction == "sink":
+                key = (self.get_fallback("source", protocol), name)
+            else:
+                key = (name, self.get_fallback("sink", protocol))
+            if None not in key:
+                wanted_dict[key] = protocol
+        return wanted_dict
+
+    def update_routes(self):
+        wanted_dict = self.get_wanted_loopbacks()
+        for (source_name, sink_name) in self.loopback_dict.keys():
+            if not wanted_dict.has_key((source_name, sink_name)):
+                self.unload_loopback(source_name, sink_name)
+        for ((source_name, sink_name), protocol) in wanted_dict.items():
+            if not self.loopback_dict.has_key((source_name, sink_name)):
+                self.load_loopback(source_name, sink_name, protocol)
+
+    def load_loopback(self, source_name, sink_name, protocol):
+        key = (source_name, sink_name)
+        args = dict(self.latency_profiles.get(protocol, dict()))
+        logging.debug(
+            "Loading loopback with source='%s' sink='%s' %s" % (
+                source_name, sink_name, " ".join(
+                    "%s='%s'" % item for item in sorted(args.items()))))
+        loopback = Loopback(source_name, sink_name, protocol, args)
+        self.loopback_dict[key] = loopback
+        def load_response(handle):
+            if self.loopback_dict.get(key) != loopback:
+                # Not wanted anymore, so get rid of it again
+                self.backend.unload_loopback(handle)
+                return
+            loopback.handle = handle
+            if protocol in self.call_driven_protocols:
+                self.log_call_setup_latency()
+            gobject.timeout_add(
+                int(self.latency_sample_interval * 1000),
+                lambda: self.sample_loopback_latency(loopback))
+        def load_error(error):
+            logging.warning("Failed to load loopback: %s" % error)
+            if self.loopback_dict.get(key) == loopback:
+                del self.loopback_dict[key]
+        self.backend.load_loopback(
+            source_name, sink_name, args,
+            traffic.wrap_handler(
+                "loopback", "load_reply", load_response, source_name,
+                sink_name),
+            traffic.wrap_handler(
+                "loopback", "load_error", load_error, source_name, sink_name))
+
+    def log_call_setup_latency(self):
+        # Only the first loopback of each call is measured
+        if self.call_start_time == None:
+            return
+        latency = time.time() - self.call_start_time
+        self.call_start_time = None
+        self.call_setup_histogram.add(latency)
+        if latency > self.call_setup_latency_threshold:
+            logging.warning("Call audio set up after %d ms" % (latency * 1000))
+        else:
+            logging.debug("Call audio set up after %d ms" % (latency * 1000))
+
+    def unload_loopback(self, source_name, sink_name):
+        key = (source_name, sink_name)
+        if not self.loopback_dict.has_key(key):
+            return
+        loopback = self.loopback_dict.pop(key)
+        logging.debug(
+            "Unloading loopback with source='%s' sink='%s'" % key)
+        loopback.log_summary()
+        if loopback.handle != None: # Otherwise load_response unloads it
+            self.backend.unload_loopback(loopback.handle)
+
+    def sample_loopback_latency(self, loopback):
+        # Returns false to be used with timeout_add
+        if self.loopback_dict.get(loopback.key()) != loopback:
+            return False # Unloaded, so stop sampling
+        def latency_response(latency):
+            if latency != None:
+                loopback.add_latency_sample(*latency)
+        self.backend.get_loopback_latency(
+            loopback.handle,
+            traffic.wrap_handler(
+                "loopback", "latency_reply", latency_response, loopback.handle))
+        return True
+
+    def dump_status(self):
+        logging.info("Backend %s connected: %s" % (
+            self.backend.name, self.backend.is_connected()))
+        logging.info("Fallback source: %s" % self.get_fallback("source"))
+        logging.info("Fallback sink: %s" % self.get_fallback("sink"))
+        logging.info("Echo cancellation devices: %s" % (
+            ", ".join(sorted(self.echo_cancel_dict.values())) or "none"))
+        logging.info("In call: %s" % self.in_call)
+        logging.info("Echo cancellation: %s" % self.get_echo_cancel_profile())
+        logging.info("Call audio setup: %s" % (
+            self.call_setup_histogram.describe()))
+        logging.info("CPU during call audio: %s" % (
+            self.cpu_meter.describe()))
+        logging.info("Active loopbacks: %d" % len(self.loopback_dict))
+        for (key, loopback) in sorted(self.loopback_dict.items()):
+            logging.info("  %s" % loopback.describe())
+
+# Changes apply to the loopbacks loaded afterwards
+for (attribute, parse) in [
+    ("unwanted_modules", config.parse_list()),
+    ("enabled_protocols", config.parse_list()),
+    ("latency_sample_interval", config.parse_float(0.5)),
+    ("call_setup_latency_threshold", config.parse_float(0)) ]:
+    config.register("loopback", LoopbackLoader, attribute, parse)
+for protocol in LoopbackLoader.latency_profiles.keys():
+    config.register_item(
+        "loopback", "latency_profile." + protocol,
+        LoopbackLoader.latency_profiles, protocol,
+        config.parse_module_arguments)
+for protocol in LoopbackLoader.echo_cancel_protocol_profiles.keys():
+    config.register_item(
+        "loopback", "echo_cancel." + protocol,
+        LoopbackLoader.echo_cancel_protocol_profiles, protocol,
+        config.parse_choice(
+            [ "off" ] + sorted(LoopbackLoader.echo_cancel_profiles.keys())))
+
+def create_replay_dispatcher():
+    # Dispatcher of the "loopback" events of a traffic capture. The loader
+    # is created by the "start" event, without following oFono, as the
+    # call state changes are part of the capture
+    state = dict()
+    def dispatch(event, args, kwargs):
+        if event == "start":
+            state["backend"] = ReplayBackend()
+            state["loader"] = LoopbackLoader(
+                args[0], state["backend"], monitor_calls=False)
+        elif not state.has_key("loader"):
+            return # Started before the capture
+        elif event == "load_reply":
+            state["backend"].deliver_load_reply(*args)
+        elif event == "load_error":
+            (source_name, sink_name, error) = args
+            state["backend"].deliver_load_reply(
+                source_name, sink_name, None, error)
+        elif event == "latency_reply":
+            state["backend"].deliver_latency_reply(*args)
+        elif event == "module_reply":
+            state["backend"].deliver_module_reply(*args)
+        elif event == "module_error":
+            (module_name, error) = args
+            state["backend"].deliver_module_reply(module_name, None, error)
+        else:
+            getattr(state["loader"], event)(*args, **kwargs)
+    dispatch.state = state # For the tests
+    return dispatch
+
+#------------------------------------------------------------------------------
+# Main
+#------------------------------------------------------------------------------
+def create_loopback_loader(command_line, device_address):
+    # Takes the options of the loopback-loader from the command line
+    for latency_flag in command_line.take_values("--latency"):
+        try:
+            (protocol, latency) = latency_flag.split(":")
+            LoopbackLoader.latency_profiles.setdefault(protocol, dict())
+            LoopbackLoader.latency_profiles[protocol]["latency_msec"] = (
+                str(int(latency)))
+        except ValueError:
+            command_line.show_syntax_and_exit()
+    for echo_cancel_flag in command_line.take_values("--echo-cancel"):
+        (protocol, separator, profile) = echo_cancel_flag.partition(":")
+        if profile != "off" and (
+            not LoopbackLoader.echo_cancel_profiles.has_key(profile)):
+            command_line.show_syntax_and_exit()
+        LoopbackLoader.echo_cancel_protocol_profiles[protocol] = profile
+    backend_classes = [ PulseAudioBackend, PipeWireBackend, MockBackend ]
+    backend_class_dict = dict(map(lambda c: (c.name, c), backend_classes))
+    backend_name = command_line.take_value(
+        "--backend", "pulseaudio", choices=backend_class_dict.keys())
+    return lambda: LoopbackLoader(
+        device_address, backend_class_dict[backend_name]())
+
+def main():
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    # Parse arguments
+    command_line = CommandLine(
+        sys.argv,
+        command_line_syntax + " " + metrics.command_line_syntax + " " +
+        traffic.command_line_syntax + " " + config.command_line_syntax +
+        " [<bt-address>]")
+    device_address = None
+    if len(command_line.nonflags) > 0:
+        device_address = command_line.nonflags[0]
+    loopback_loader_factory = create_loopback_loader(
+        command_line, device_address)
+    metrics_exporter_factory = metrics.create_metrics_exporter(command_line)
+    record_path = command_line.take_value("--record")
+    config_factory = config.create_config(command_line)
+    command_line.finish(1)
+    traffic.start_recording(record_path)
+    runtime_config = config_factory()
+
+    # Run main loop
+    loopback_loader = loopback_loader_factory()
+    metrics_exporter = metrics_exporter_factory()
+    signal.signal(
+        signal.SIGUSR1, lambda signum, frame: loopback_loader.dump_status())
+    run_main_loop()
+
+if __name__ == "__main__":
+    main()
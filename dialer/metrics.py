@@ -0,0 +1,260 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import socket
+import gobject
+import logging
+
+# Counters, gauges and histograms in the Prometheus text format. Updating a
+# metric is a dictionary lookup and an addition in the thread of the main
+# loop; the text is only built when someone asks for it, through a Unix
+# socket served by the main loop or a file written periodically
+
+#------------------------------------------------------------------------------
+# Metric
+#------------------------------------------------------------------------------
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value_dict = dict() # Label items -> value
+
+    def get_key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def format_name(self, name, key):
+        if len(key) == 0:
+            return name
+        return "%s{%s}" % (name, ",".join(map(
+            lambda (label, value): '%s="%s"' % (
+                label, str(value).replace("\\", "\\\\").replace('"', '\\"')),
+            key)))
+
+    def format_samples(self):
+        return map(lambda (key, value): "%s %s" % (
+            self.format_name(self.name, key), format_value(value)),
+            sorted(self.value_dict.items()))
+
+    def format(self):
+        return [ "# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s %s" % (self.name, self.metric_type) ] + (
+            self.format_samples())
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.value_dict[key] = self.value_dict.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.value_dict.get(self.get_key(labels), 0)
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name, help_text):
+        Metric.__init__(self, name, help_text)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.value_dict[self.get_key(labels)] = value
+
+    def set_function(self, function):
+        # The value is taken from the function whenever it is exported
+        self.function = function
+
+    def format_samples(self):
+        if self.function != None:
+            self.set(self.function())
+        return Metric.format_samples(self)
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, bucket_limits, unit=""):
+        Metric.__init__(self, name, help_text)
+        self.bucket_limits = bucket_limits # Upper limits, ascending
+        self.unit = unit # Only used by describe()
+
+    def add(self, value, **labels):
+        key = self.get_key(labels)
+        if not self.value_dict.has_key(key):
+            # Bucket counts (last: overflow), count, total and maximum
+            self.value_dict[key] = [
+                [ 0 ] * (len(self.bucket_limits) + 1), 0, 0, 0 ]
+        data = self.value_dict[key]
+        index = len(self.bucket_limits)
+        for (i, limit) in enumerate(self.bucket_limits):
+            if value <= limit:
+                index = i
+                break
+        data[0][index] += 1
+        data[1] += 1
+        data[2] += value
+        data[3] = max(value, data[3])
+
+    def get_count(self, **labels):
+        data = self.value_dict.get(self.get_key(labels))
+        if data == None:
+            return 0
+        return data[1]
+
+    def describe(self, **labels):
+        # Human readable summary, for logging
+        data = self.value_dict.get(self.get_key(labels))
+        if data == None:
+            return "no samples"
+        (bucket_counts, count, total, maximum) = data
+        buckets = map(
+            lambda (limit, count): "<=%g%s:%d" % (limit, self.unit, count),
+            zip(self.bucket_limits, bucket_counts))
+        buckets.append(">%g%s:%d" % (
+            self.bucket_limits[-1], self.unit, bucket_counts[-1]))
+        return "n=%d avg=%.2f%s max=%.2f%s %s" % (
+            count, float(total) / count, self.unit, maximum, self.unit,
+            " ".join(buckets))
+
+    def format_samples(self):
+        lines = []
+        for (key, (bucket_counts, count, total, maximum)) in sorted(
+            self.value_dict.items()):
+            cumulative_count = 0
+            for (limit, bucket_count) in zip(
+                self.bucket_limits + [ float("inf") ], bucket_counts):
+                cumulative_count += bucket_count
+                lines.append("%s %d" % (
+                    self.format_name(
+                        self.name + "_bucket",
+                        key + (("le", format_value(limit)),)),
+                    cumulative_count))
+            lines.append("%s %s" % (
+                self.format_name(self.name + "_sum", key), format_value(total)))
+            lines.append("%s %d" % (
+                self.format_name(self.name + "_count", key), count))
+        return lines
+
+#------------------------------------------------------------------------------
+# MetricsRegistry
+#------------------------------------------------------------------------------
+class MetricsRegistry:
+    def __init__(self):
+        self.metric_dict = dict() # Name -> Metric
+
+    def add(self, metric):
+        # Registering the same name twice returns the first metric
+        return self.metric_dict.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text):
+        return self.add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.add(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, bucket_limits, unit=""):
+        return self.add(Histogram(name, help_text, bucket_limits, unit))
+
+    def format(self):
+        lines = []
+        for name in sorted(self.metric_dict.keys()):
+            lines += self.metric_dict[name].format()
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry() # Shared by all components of a process
+
+#------------------------------------------------------------------------------
+# MetricsExporter
+#------------------------------------------------------------------------------
+class MetricsExporter:
+    file_interval = 15.0
+    send_timeout = 1.0
+
+    def __init__(self, registry, socket_path=None, file_path=None):
+        self.registry = registry
+        self.socket_path = socket_path
+        self.file_path = file_path
+        self.server_socket = None
+        if socket_path != None:
+            self.start_server()
+        if file_path != None:
+            self.write_file()
+            gobject.timeout_add(
+                int(self.file_interval * 1000), self.write_file)
+
+    def start_server(self):
+        # Every client gets the current metrics and the connection is closed
+        try:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path) # Left over by a previous run
+            self.server_socket = socket.socket(
+                socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server_socket.bind(self.socket_path)
+            self.server_socket.listen(5)
+        except socket.error, e:
+            logging.warning("Cannot listen on %s: %s" % (self.socket_path, e))
+            self.server_socket = None
+            return
+        gobject.io_add_watch(
+            self.server_socket.fileno(), gobject.IO_IN, self.client_connected)
+
+    def client_connected(self, fd, condition):
+        try:
+            (client_socket, address) = self.server_socket.accept()
+        except socket.error:
+            return True
+        try:
+            client_socket.settimeout(self.send_timeout)
+            client_socket.sendall(self.registry.format())
+        except socket.error, e:
+            logging.debug("Cannot send metrics: %s" % e)
+        client_socket.close()
+        return True
+
+    def write_file(self):
+        # Returns true to be used with timeout_add
+        try:
+            temp_file = self.file_path + ".tmp"
+            f = open(temp_file, "w")
+            f.write(self.registry.format())
+            f.close()
+            os.rename(temp_file, self.file_path)
+        except (IOError, OSError), e:
+            logging.warning("Cannot write %s: %s" % (self.file_path, e))
+        return True
+
+command_line_syntax = "[--metrics-socket=<path>] [--metrics-file=<path>]"
+
+def create_metrics_exporter(command_line):
+    # Takes the metrics options from the command line
+    socket_path = command_line.take_value("--metrics-socket")
+    file_path = command_line.take_value("--metrics-file")
+    def factory():
+        if socket_path == None and file_path == None:
+            return None
+        return MetricsExporter(registry, socket_path, file_path)
+    return factory
@@ -21,9 +21,23 @@ import sys
 import dbus
 import dbus.mainloop.glib
 import os
+import signal
 import subprocess
+import gobject
+import time
+import Queue
 import resources
 import logging
+import metrics
+import traffic
+import contacts
+import watchdog
+import instance
+import flightrecorder
+import config
+import snapshot
+from flightrecorder import trace
+from common import CommandLine, gather_replies, install_signal_wakeup
 from PyQt4 import QtGui, QtCore, uic
 
 import distutils.sysconfig
@@ -35,17 +49,36 @@ def get_resource_path(filename):
 	return os.path.join(distutils.sysconfig.get_python_lib(),
 			    'opendialer', filename)
 
+#------------------------------------------------------------------------------
+# Metrics
+#------------------------------------------------------------------------------
+signals_received_counter = metrics.registry.counter(
+    "dialer_dbus_signals_received_total",
+    "oFono signals received by the dialer")
+signals_handled_counter = metrics.registry.counter(
+    "dialer_dbus_signals_handled_total",
+    "oFono signals about the modem of the dialer")
+widget_updates_counter = metrics.registry.counter(
+    "dialer_widget_updates_total",
+    "Call state changes applied to the widgets, or deferred while hidden")
+call_setup_histogram = metrics.registry.histogram(
+    "dialer_call_setup_seconds",
+    "Time from an outgoing call being added until it got active",
+    [ 1, 2, 5, 10, 20, 30, 60 ], "s")
+
 #------------------------------------------------------------------------------
 # Local helper functions
 #------------------------------------------------------------------------------
-def show_syntax_and_exit():
-    print "Syntax:"
-    print "  %s -h, --help" % sys.argv[0]
-    print "  %s [-d, --debug] [<modem-path>]" % sys.argv[0]
-    sys.exit(0)
+async_calls_enabled = True # Disabled while replaying traffic
+dbus_call_timeout = 25.0 # Seconds, the default of libdbus
 
 def try_async_dbus_call(object_path, interface_suffix, method_name,
                         expect_return_value, *args):
+    if not async_calls_enabled:
+        trace("Not calling %s %s", method_name, args)
+        return
+    trace("Calling %s.%s%s on %s", interface_suffix, method_name, args,
+          object_path)
     try:
         interface = dbus.Interface(
             dbus.SystemBus().get_object("org.ofono", object_path),
@@ -56,7 +89,8 @@ def try_async_dbus_call(object_path, interface_suffix, method_name,
             reply_func = lambda x: None
         else:
             reply_func = lambda: None
-        method(*args, reply_handler=reply_func, error_handler=lambda e: None)
+        method(*args, reply_handler=reply_func, error_handler=lambda e: None,
+               timeout=dbus_call_timeout)
     except dbus.exceptions.DBusException:
         pass # Omit silently
 
@@ -69,6 +103,15 @@ class VoiceCall:
         self.voicecall_path = voicecall_path
         self.properties = voicecall_properties
         self.assigned_display = None # Setter is CallDisplay.assign_voicecall
+        # Outgoing calls measure their setup time until they get active
+        self.setup_start_time = None
+        if voicecall_properties.get("State") in [ "dialing", "alerting" ]:
+            self.setup_start_time = time.time()
+
+    def state_changed(self, state):
+        if state == "active" and self.setup_start_time != None:
+            call_setup_histogram.add(time.time() - self.setup_start_time)
+            self.setup_start_time = None
 
 #------------------------------------------------------------------------------
 # VoiceCallDisplay
@@ -155,7 +198,12 @@ class VoiceCallDisplay:
             if self.is_multiparty():
                 display_text = "multiparty"
             elif self.voicecall.properties.has_key("LineIdentification"):
-                display_text = self.voicecall.properties["LineIdentification"]
+                number = self.voicecall.properties["LineIdentification"]
+                name = self.main_window.contacts.lookup(number)
+                if name != None:
+                    display_text = "%s (%s)" % (name, number)
+                else:
+                    display_text = number
 
         # Check voicecall state
         voicecall_state = self.get_voicecall_state()
@@ -266,21 +314,72 @@ class VoiceCallDisplay:
         try_async_dbus_call(
             self.modem_path, "VoiceCallManager", "HoldAndAnswer", False)
 
+    def get_state(self):
+        state = { "Call": "", "State": self.get_voicecall_state(),
+                  "Number": "", "Name": "", "Multiparty": self.is_multiparty() }
+        if self.voicecall != None:
+            state["Call"] = self.voicecall.voicecall_path
+            number = self.voicecall.properties.get("LineIdentification", "")
+            state["Number"] = number
+            state["Name"] = self.main_window.contacts.lookup(number) or ""
+        return state
+
 #------------------------------------------------------------------------------
 # PhoneDialog
 #------------------------------------------------------------------------------
 class PhoneDialog(QtGui.QMainWindow):
 
     pbap_gui_path = "../pbap-gui/"
-
-    def __init__(self, modem_path):
+    contacts_path = "contacts.vcf"
+    # The contacts are added to the combo box in slices of this many seconds
+    # at most, whenever the event loop is idle, a few numbers at a time
+    import_slice_time = 0.005
+    import_batch_size = 20
+    import_wait_interval = 50 # Msec between slices while nothing is queued
+    import_progress_interval = 1.0
+    # Widgets of a hidden or minimized window are only updated once it is
+    # shown again, but a new incoming call brings it up right away
+    raise_on_incoming_call = True
+    ringing_states = [ "incoming", "waiting" ]
+    snapshot_path = snapshot.default_path
+
+    def __init__(self, modem_path, use_dbus=True, follow_default_modem=False):
+        # Without D-Bus, the state and the signals are fed by the replayer.
+        # follow_default_modem is set when the modem was taken from the
+        # snapshot instead of being given, to switch to the default one if
+        # it is gone
         self.modem_path = modem_path
+        self.follow_default_modem = follow_default_modem
         self.pending_dial = None
+        self.modem_powered = False
+        self.call_dict = dict()
+        self.device_address = None
         self.displays = [] # Necessary for first reconnect()
+        self.contacts = contacts.ContactIndex()
+        self.state_callbacks = [] # Called after every widget update
+        self.widget_update_pending = False
+        self.ringing_call_paths = set()
+        self.call_snapshot = None
+        self.snapshot_write_pending = False
+        metrics.registry.gauge(
+            "dialer_active_calls",
+            "Calls of the modem which are not disconnected").set_function(
+            lambda: len(filter(
+                lambda c: c.properties["State"] != "disconnected",
+                self.call_dict.values())))
         self.init_gui()
-        self.reconnect()
+        if use_dbus:
+            traffic.record("dialer", "start", modem_path)
+            # The calls of a previous run are shown until oFono replies
+            self.call_snapshot = snapshot.CallSnapshot(self.snapshot_path)
+            if self.restore_snapshot():
+                self.reconnect_async()
+            else:
+                self.reconnect()
+            self.install_dbus_signal_receivers()
         self.install_signal_receivers()
         self.load_phonebook()
+        self.load_contacts()
         self.update_widget_state()
 
     def init_gui(self):
@@ -321,51 +420,190 @@ class PhoneDialog(QtGui.QMainWindow):
         self._button_dict["#"] = self.ui.buttonHash
 
     def reconnect(self):
-        self.modem_powered = False
-        self.call_dict = dict()
-        for display in self.displays:
-            display.assign_voicecall(None)
         modem_interface = dbus.Interface(
             dbus.SystemBus().get_object("org.ofono", self.modem_path),
             "org.ofono.Modem")
-        modem_properties = modem_interface.GetProperties()
-        self.modem_powered = bool(modem_properties["Powered"])
-        self.ui.setWindowTitle(modem_properties["Name"])
-        self.device_address = modem_properties.get("Serial")
+        try:
+            modem_properties = modem_interface.GetProperties()
+        except dbus.exceptions.DBusException, e:
+            if not self.follow_default_modem:
+                raise
+            logging.warning("Modem %s is gone: %s" % (self.modem_path, e))
+            try:
+                manager = dbus.Interface(
+                    dbus.SystemBus().get_object("org.ofono", "/"),
+                    "org.ofono.Manager")
+                modems = manager.GetModems()
+            except dbus.exceptions.DBusException:
+                modems = None
+            if self.switch_to_default_modem(modems):
+                self.reconnect()
+                return
+            modem_properties = { "Powered": False, "Name": self.modem_path }
+        calls = []
         try:
             voicecallmanager_interface = dbus.Interface(
                 dbus.SystemBus().get_object("org.ofono", self.modem_path),
                 "org.ofono.VoiceCallManager")
-            for (path, properties) in voicecallmanager_interface.GetCalls():
-                self.register_call(path, properties)
+            calls = voicecallmanager_interface.GetCalls()
         except dbus.exceptions.DBusException:
             pass # Modem probably not powered
+        traffic.record("dialer", "set_modem_state", modem_properties, calls)
+        self.set_modem_state(modem_properties, calls)
+
+    def reconnect_async(self):
+        # Same as reconnect(), without blocking the event loop. The calls
+        # keep the displays they have
+        def state_response(replies):
+            (modem_properties, calls) = replies
+            if modem_properties == None and self.follow_default_modem:
+                self.reconnect_default_modem_async()
+                return
+            if modem_properties == None:
+                logging.warning("Modem %s is gone" % self.modem_path)
+                modem_properties = { "Powered": False,
+                                     "Name": self.modem_path }
+            display_call_paths = self.get_display_call_paths()
+            traffic.record("dialer", "set_modem_state", modem_properties,
+                           calls or [], display_call_paths)
+            self.set_modem_state(
+                modem_properties, calls or [], display_call_paths)
+            self.update_widget_state()
+        def request(interface_name, method_name):
+            def send(reply_handler):
+                try:
+                    method = getattr(dbus.Interface(
+                        dbus.SystemBus().get_object(
+                            "org.ofono", self.modem_path),
+                        interface_name), method_name)
+                    method(reply_handler=reply_handler,
+                           error_handler=lambda e: reply_handler(None))
+                except dbus.exceptions.DBusException:
+                    reply_handler(None)
+            return send
+        gather_replies(
+            [ request("org.ofono.Modem", "GetProperties"),
+              request("org.ofono.VoiceCallManager", "GetCalls") ],
+            state_response)
+
+    def reconnect_default_modem_async(self):
+        # Same as the fallback of reconnect(), without blocking
+        def modems_response(modems):
+            self.switch_to_default_modem(modems)
+            self.reconnect_async()
+        try:
+            manager = dbus.Interface(
+                dbus.SystemBus().get_object("org.ofono", "/"),
+                "org.ofono.Manager")
+            manager.GetModems(
+                reply_handler=modems_response,
+                error_handler=lambda e: modems_response(None))
+        except dbus.exceptions.DBusException:
+            modems_response(None)
+
+    def switch_to_default_modem(self, modems):
+        # The modem of the snapshot is gone, so take the first one of the
+        # GetModems() reply, as if there had been no snapshot. Returns true
+        # if there is one
+        self.follow_default_modem = False
+        if modems == None or len(modems) == 0:
+            return False
+        logging.info("Modem %s is gone, using %s" % (
+            self.modem_path, modems[0][0]))
+        traffic.record("dialer", "set_modem_path", modems[0][0])
+        self.set_modem_path(modems[0][0])
+        return True
 
-    def install_signal_receivers(self):
+    def set_modem_path(self, modem_path):
+        self.modem_path = modem_path
+        for display in self.displays:
+            display.modem_path = modem_path
+
+    def get_display_call_paths(self):
+        return map(lambda d: d.voicecall and d.voicecall.voicecall_path,
+                   self.displays)
+
+    def set_modem_state(self, modem_properties, calls,
+                        display_call_paths=None):
+        # Calls listed in display_call_paths get the same display again
+        self.call_dict = dict()
+        for display in self.displays:
+            display.assign_voicecall(None)
+        self.modem_powered = bool(modem_properties["Powered"])
+        self.ui.setWindowTitle(modem_properties["Name"])
+        self.device_address = modem_properties.get("Serial")
+        display_dict = dict(zip(display_call_paths or [], self.displays))
+        for (path, properties) in sorted(
+            calls, key=lambda (path, properties):
+                not display_dict.has_key(path)):
+            self.register_call(path, properties, display_dict.get(path))
+
+    def restore_snapshot(self):
+        # Returns true if the state was taken from the snapshot
+        call_snapshot = self.call_snapshot.load(self.modem_path)
+        if call_snapshot == None:
+            return False
+        try:
+            self.set_modem_state(
+                call_snapshot["modem_properties"], call_snapshot["calls"],
+                call_snapshot["displays"])
+        except (KeyError, TypeError, ValueError), e:
+            logging.warning("Ignoring call snapshot: %s" % e)
+            self.set_modem_state({ "Powered": False,
+                                   "Name": self.modem_path }, [])
+            return False
+        trace("Restored %d calls from snapshot", len(self.call_dict))
+        return True
+
+    def save_snapshot(self):
+        # Returns false to be used with idle_add
+        self.snapshot_write_pending = False
+        self.call_snapshot.save(traffic.to_plain({
+            "modem": self.modem_path,
+            "modem_properties": {
+                "Powered": self.modem_powered,
+                "Name": unicode(self.ui.windowTitle()),
+                "Serial": self.device_address },
+            "calls": map(lambda c: [ c.voicecall_path, c.properties ],
+                         self.call_dict.values()),
+            "displays": self.get_display_call_paths() }))
+        return False
+
+    def install_dbus_signal_receivers(self):
         bus = dbus.SystemBus()
         bus.add_signal_receiver(
-            self.signal_ofono_name_owner_changed,
+            traffic.wrap_handler(
+                "dialer", "signal_ofono_name_owner_changed",
+                self.signal_ofono_name_owner_changed),
             dbus_interface="org.freedesktop.DBus",
-            signal_name="NameOwnerChanged")
+            signal_name="NameOwnerChanged",
+            arg0="org.ofono")
         bus.add_signal_receiver(
-            self.signal_modem_property_changed,
+            traffic.wrap_handler(
+                "dialer", "signal_modem_property_changed",
+                self.signal_modem_property_changed),
             dbus_interface="org.ofono.Modem",
             signal_name="PropertyChanged",
             path_keyword="modem_path")
         bus.add_signal_receiver(
-            self.signal_call_added,
+            traffic.wrap_handler(
+                "dialer", "signal_call_added", self.signal_call_added),
             dbus_interface="org.ofono.VoiceCallManager",
             signal_name="CallAdded")
         bus.add_signal_receiver(
-            self.signal_call_removed,
+            traffic.wrap_handler(
+                "dialer", "signal_call_removed", self.signal_call_removed),
             dbus_interface="org.ofono.VoiceCallManager",
             signal_name="CallRemoved")
         bus.add_signal_receiver(
-            self.signal_voicecall_property_changed,
+            traffic.wrap_handler(
+                "dialer", "signal_voicecall_property_changed",
+                self.signal_voicecall_property_changed),
             dbus_interface="org.ofono.VoiceCall",
             signal_name="PropertyChanged",
             path_keyword="call_path")
 
+    def install_signal_receivers(self):
         self.ui.installEventFilter(self)
         for (char, button) in self._button_dict.items():
             self.connect_button(char, button)
@@ -396,6 +634,78 @@ class PhoneDialog(QtGui.QMainWindow):
             pass # Omit silently
         self.ui.dialerComboBox.setVisible(True)
 
+    def load_contacts(self):
+        # The contacts are read on a background thread, which builds the
+        # caller name index and queues the numbers for the combo box
+        self.contacts_loading = True
+        self.import_queue = Queue.Queue()
+        self.import_numbers = set(map(
+            lambda i: unicode(self.ui.dialerComboBox.itemText(i)),
+            range(self.ui.dialerComboBox.count())))
+        self.import_count = 0
+        self.import_start_time = time.time()
+        self.import_progress_time = self.import_start_time
+        try:
+            self.import_size = os.path.getsize(self.contacts_path)
+        except OSError:
+            self.import_size = None
+        self.import_timer = QtCore.QTimer()
+        self.connect(self.import_timer, QtCore.SIGNAL("timeout()"),
+                     self.import_slice)
+        self.connect(self, QtCore.SIGNAL("contactsLoaded()"),
+                     self.contacts_loaded)
+        self.contacts.load_in_background(
+            self.contacts_path,
+            lambda: self.emit(QtCore.SIGNAL("contactsLoaded()")),
+            lambda (name, numbers): self.import_queue.put(numbers))
+        self.import_timer.start(0)
+
+    def contacts_loaded(self):
+        # Calls already shown get their names
+        self.contacts_loading = False
+        self.update_widget_state()
+
+    def import_slice(self):
+        deadline = time.time() + self.import_slice_time
+        combo_box = self.ui.dialerComboBox
+        old_text = combo_box.currentText()
+        while time.time() < deadline:
+            batch = []
+            while (len(batch) < self.import_batch_size and
+                   not self.import_queue.empty()):
+                for number in self.import_queue.get():
+                    if number not in self.import_numbers:
+                        self.import_numbers.add(number)
+                        batch.append(number)
+            if len(batch) == 0:
+                break
+            combo_box.addItems(batch)
+            self.import_count += len(batch)
+        combo_box.setEditText(old_text)
+        if self.import_queue.empty():
+            self.import_timer.setInterval(self.import_wait_interval)
+        else:
+            self.import_timer.setInterval(0)
+        reader = self.contacts.reader
+        if not(self.contacts_loading) and self.import_queue.empty():
+            self.import_timer.stop()
+            elapsed = time.time() - self.import_start_time
+            if reader != None and reader.cards_read > 0:
+                logging.info(
+                    "Imported %d numbers of %d contacts in %.2f s "
+                    "(%d contacts/s)" % (
+                        self.import_count, reader.cards_read, elapsed,
+                        reader.cards_read / max(elapsed, 0.001)))
+        elif (reader != None and time.time() - self.import_progress_time >
+              self.import_progress_interval):
+            self.import_progress_time = time.time()
+            progress = ""
+            if self.import_size:
+                progress = " (%d%%)" % (
+                    reader.bytes_read * 100 / self.import_size)
+            logging.info("Importing contacts: %d read, %d numbers added%s" % (
+                reader.cards_read, self.import_count, progress))
+
     def connect_button(self, char, button):
         self.connect(button, QtCore.SIGNAL("clicked()"),
                      lambda: self.number_clicked(char))
@@ -448,20 +758,40 @@ class PhoneDialog(QtGui.QMainWindow):
     def dialer_item_activated(self, number_string):
         # Clear the combo box
         self.ui.dialerComboBox.clearEditText()
+        self.dial_number(str(number_string))
+
+    def dial_number(self, number):
         # Perform the call
         # FIXME: this is probably racy
         if self.get_current_state_string() == "active":
-            self.pending_dial = str(number_string)
+            self.pending_dial = number
             try_async_dbus_call(
                 self.modem_path, "VoiceCallManager", "SwapCalls", False)
         else:
             self.pending_dial = None
             try_async_dbus_call(
                 self.modem_path, "VoiceCallManager", "Dial", True,
-                str(number_string), "")
+                number, "")
+
+    def raise_window(self):
+        self.ui.showNormal()
+        self.ui.raise_()
+        self.ui.activateWindow()
+        self.window_shown()
+
+    def is_window_visible(self):
+        return self.ui.isVisible() and not self.ui.isMinimized()
+
+    def window_shown(self):
+        # Catches up with the changes while hidden
+        if self.widget_update_pending and self.is_window_visible():
+            self.apply_widget_state()
 
     def eventFilter(self,  obj,  event):
-        if event.type() == QtCore.QEvent.KeyPress:
+        if event.type() in [ QtCore.QEvent.Show,
+                             QtCore.QEvent.WindowStateChange ]:
+            self.window_shown()
+        elif event.type() == QtCore.QEvent.KeyPress:
             if event.key() == QtCore.Qt.Key_Escape:
                 return False
             elif event.key() == QtCore.Qt.Key_Backspace:
@@ -486,15 +816,21 @@ class PhoneDialog(QtGui.QMainWindow):
         return modem_path
 
     def signal_ofono_name_owner_changed(self, name, old_owner, new_owner):
+        signals_received_counter.inc(signal="NameOwnerChanged")
         if name == "org.ofono":
+            signals_handled_counter.inc(signal="NameOwnerChanged")
+            trace("oFono owner: %s", new_owner)
             if new_owner != "":
                 self.reconnect()
                 self.update_widget_state()
 
     def signal_modem_property_changed(
         self, property_name, property_value, modem_path):
+        signals_received_counter.inc(signal="ModemPropertyChanged")
         if modem_path != self.modem_path:
             return
+        signals_handled_counter.inc(signal="ModemPropertyChanged")
+        trace("Modem property %s: %s", property_name, property_value)
         if property_name == "Powered":
             self.modem_powered = bool(property_value)
             if not self.modem_powered:
@@ -502,23 +838,25 @@ class PhoneDialog(QtGui.QMainWindow):
             self.update_widget_state()
 
     def signal_call_added(self, call_path, properties):
+        signals_received_counter.inc(signal="CallAdded")
         modem_path = self.get_modem_path_from_call_path(call_path)
         if modem_path != self.modem_path:
             return
-        logging.debug("Call added: %s" % call_path)
+        signals_handled_counter.inc(signal="CallAdded")
+        trace("Call added: %s", call_path)
         self.register_call(call_path, properties)
 
-    def register_call(self, call_path, properties):
+    def register_call(self, call_path, properties, preferred_display=None):
         self.pending_dial = None
         new_call = VoiceCall(call_path, properties)
         self.call_dict[call_path] = new_call
-        for display in self.displays:
-            if display.voicecall == None:
+        for display in [ preferred_display ] + self.displays:
+            if display != None and display.voicecall == None:
                 display.assign_voicecall(new_call)
                 break
         if new_call.properties.has_key("LineIdentification"):
             number = new_call.properties["LineIdentification"]
-            logging.debug("Registering call with number %s" % number)
+            trace("Registering call with number %s", number)
             if self.ui.dialerComboBox.findText(number) < 0:
                 old_text = self.ui.dialerComboBox.currentText()
                 self.ui.dialerComboBox.addItem(number)
@@ -551,10 +889,12 @@ class PhoneDialog(QtGui.QMainWindow):
                         first_free_display.assign_voicecall(call)
 
     def signal_call_removed(self, call_path):
+        signals_received_counter.inc(signal="CallRemoved")
         modem_path = self.get_modem_path_from_call_path(call_path)
         if modem_path != self.modem_path:
             return
-        logging.debug("Call removed: %s" % call_path)
+        signals_handled_counter.inc(signal="CallRemoved")
+        trace("Call removed: %s", call_path)
         if self.call_dict.has_key(call_path):
             removed_call = self.call_dict[call_path]
             display = removed_call.assigned_display
@@ -569,17 +909,22 @@ class PhoneDialog(QtGui.QMainWindow):
 
     def signal_voicecall_property_changed(
         self, property_name, property_value, call_path):
+        signals_received_counter.inc(signal="CallPropertyChanged")
         modem_path = self.get_modem_path_from_call_path(call_path)
         if modem_path != self.modem_path:
             return
         if not self.call_dict.has_key(call_path):
             return
+        signals_handled_counter.inc(signal="CallPropertyChanged")
+        trace("Call property %s of %s: %s", property_name, call_path,
+              property_value)
         old_state = self.get_current_state_string()
         voicecall = self.call_dict[call_path]
         voicecall.properties[property_name] = property_value
         new_state = self.get_current_state_string()
         if property_name == "State":
-            logging.debug("Voicecall state changed to '%s'" % new_state)
+            trace("Voicecall state changed to '%s'", new_state)
+            voicecall.state_changed(property_value)
             if self.pending_dial != None:
                 if new_state == "held":
                     # Dial pending number
@@ -629,6 +974,37 @@ class PhoneDialog(QtGui.QMainWindow):
 
     def update_widget_state(self):
         call_state = self.get_current_state_string()
+        trace("Call state: %s, %d calls", call_state,
+              len(self.call_dict))
+        if not self.modem_powered:
+            for display in self.displays:
+                display.assign_voicecall(None)
+
+        # Raise the window for every new ringing call
+        ringing_call_paths = set(filter(
+            lambda path: self.call_dict[path].properties.get("State") in (
+                self.ringing_states),
+            self.call_dict.keys()))
+        self.widget_update_pending = True
+        if self.raise_on_incoming_call and not self.is_window_visible() and (
+            len(ringing_call_paths - self.ringing_call_paths) > 0):
+            self.raise_window()
+        self.ringing_call_paths = ringing_call_paths
+        self.window_shown()
+        if self.widget_update_pending:
+            trace("Window hidden, widget update deferred")
+            widget_updates_counter.inc(result="deferred")
+        if self.call_snapshot != None and not self.snapshot_write_pending:
+            self.snapshot_write_pending = True
+            gobject.idle_add(self.save_snapshot)
+
+        for callback in self.state_callbacks:
+            callback()
+
+    def apply_widget_state(self):
+        widget_updates_counter.inc(result="applied")
+        self.widget_update_pending = False
+        call_state = self.get_current_state_string()
 
         # Set the state of common widgets
         dialing_enabled = (
@@ -649,8 +1025,6 @@ class PhoneDialog(QtGui.QMainWindow):
         self.ui.buttonPower.setVisible(not self.modem_powered)
         if not self.modem_powered:
             self.ui.statusLabel.setText("not-powered")
-            for display in self.displays:
-                display.assign_voicecall(None)
         else:
             self.ui.statusLabel.setText(call_state)
 
@@ -691,6 +1065,63 @@ class PhoneDialog(QtGui.QMainWindow):
         self.ui.buttonPbap.setEnabled(
             (self.device_address != None) and (call_state == "disconnected"))
 
+    def get_state(self):
+        # Aggregated state and what each display shows
+        state = "not-powered"
+        if self.modem_powered:
+            state = self.get_current_state_string()
+        return { "State": state,
+                 "Powered": self.modem_powered,
+                 "Displays": map(lambda d: d.get_state(), self.displays) }
+
+    def answer(self):
+        # Same as the green button of the ringing call
+        for display in self.displays:
+            voicecall_state = display.get_voicecall_state()
+            if voicecall_state == "incoming":
+                display.do_answer()
+                return True
+            elif voicecall_state == "waiting":
+                display.do_hold_and_answer()
+                return True
+        return False
+
+    def swap(self):
+        try_async_dbus_call(
+            self.modem_path, "VoiceCallManager", "SwapCalls", False)
+
+config.register("dialer", sys.modules[__name__], "dbus_call_timeout",
+                config.parse_float(1))
+for (attribute, parse) in [
+    ("pbap_gui_path", config.parse_string),
+    ("import_slice_time", config.parse_float(0.001, 0.1)),
+    ("import_batch_size", config.parse_int(1)),
+    ("import_wait_interval", config.parse_int(1)),
+    ("raise_on_incoming_call", config.parse_bool),
+    ("snapshot_path", config.parse_string) ]:
+    config.register("dialer", PhoneDialog, attribute, parse)
+
+def create_replay_dispatcher():
+    # Dispatcher of the "dialer" events of a traffic capture. The dialog is
+    # created by the "start" event, and nothing is sent to oFono
+    state = dict()
+    def dispatch(event, args, kwargs):
+        global async_calls_enabled
+        if event == "start":
+            async_calls_enabled = False
+            state["dialog"] = PhoneDialog(args[0], use_dbus=False)
+        elif not state.has_key("dialog"):
+            return # Started before the capture
+        elif event == "signal_ofono_name_owner_changed":
+            pass # Its reconnection is recorded as set_modem_state
+        elif event == "set_modem_state":
+            state["dialog"].set_modem_state(*args)
+            state["dialog"].update_widget_state()
+        else:
+            getattr(state["dialog"], event)(*args, **kwargs)
+    dispatch.state = state # For the tests
+    return dispatch
+
 #------------------------------------------------------------------------------
 # Main
 #------------------------------------------------------------------------------
@@ -699,27 +1130,54 @@ def main():
 	app = QtGui.QApplication(sys.argv)
 
         # Parse arguments
-        modem_path = None
-        logging_level = logging.INFO
-        flags = set(filter(lambda x: x.startswith("-"), sys.argv[1:]))
-        nonflags = set(filter(lambda x: not(x.startswith("-")), sys.argv[1:]))
-        if "-h" in flags or "--help" in flags:
-            show_syntax_and_exit()
-        if "-d" in flags or "--debug" in flags:
-            flags.discard("-d")
-            flags.discard("-debug")
-            logging_level = logging.DEBUG
-        if len(nonflags) > 1 or len(flags) > 0:
-            show_syntax_and_exit()
-        if len(nonflags) == 1:
-            modem_path = list(nonflags)[0]
-
-        # Initialize logging system
-        logging.basicConfig(
-            format = "[%(asctime)s] %(message)s",
-            level = logging_level)
-
-        # Take default modem
+        command_line = CommandLine(
+            sys.argv,
+            "[--contacts=<vcard-file>] [--country-code=<code>] " +
+            metrics.command_line_syntax + " " + traffic.command_line_syntax +
+            " " + watchdog.command_line_syntax +
+            " " + config.command_line_syntax +
+            " [<modem-path>] [<number>|tel:<number>]",
+            [ "If a dialer is running already, the number is dialed by it." ])
+        (modem_path, number) = instance.get_number_arguments(
+            command_line.nonflags)
+        metrics_exporter_factory = metrics.create_metrics_exporter(
+            command_line)
+        record_path = command_line.take_value("--record")
+        watchdog_threshold = command_line.take_value("--watchdog", None, int)
+        config_factory = config.create_config(command_line)
+        PhoneDialog.contacts_path = command_line.take_value(
+            "--contacts", PhoneDialog.contacts_path)
+        country_code = command_line.take_value("--country-code")
+        if country_code != None:
+            contacts.ContactIndex.country_code = country_code.lstrip("+")
+        command_line.finish(2)
+        # The first dialer to own the name runs, any other hands over
+        dialer_service = instance.register()
+        if dialer_service == None and (
+            instance.forward_to_running_instance(sys.argv[1:])):
+            sys.exit(0)
+        traffic.start_recording(record_path)
+        runtime_config = config_factory()
+        main_loop_watchdog = watchdog.start_watchdog(watchdog_threshold)
+
+        # Dump the last events on SIGUSR1, crashes and stalls
+        install_signal_wakeup()
+        signal.signal(signal.SIGUSR1, lambda signum, frame:
+                      flightrecorder.recorder.dump("SIGUSR1"))
+        flightrecorder.install_crash_dump()
+        if main_loop_watchdog != None:
+            main_loop_watchdog.stall_callbacks.append(
+                lambda: flightrecorder.recorder.dump("main loop stall"))
+
+        # Take the modem of the last run, whose calls are shown right away
+        # while oFono is asked in the background, or else the default modem
+        follow_default_modem = False
+        if modem_path == None:
+            last_snapshot = snapshot.CallSnapshot(
+                PhoneDialog.snapshot_path).load()
+            if last_snapshot != None:
+                modem_path = last_snapshot["modem"]
+                follow_default_modem = True
         if modem_path == None:
             manager = dbus.Interface(
                 dbus.SystemBus().get_object("org.ofono", "/"),
@@ -730,7 +1188,13 @@ def main():
                 sys.exit(1)
             modem_path = modems[0][0]
 
-	win = PhoneDialog(modem_path)
+	win = PhoneDialog(
+            modem_path, follow_default_modem=follow_default_modem)
+        if dialer_service != None:
+            dialer_service.set_dialog(win)
+        if number != None:
+            win.dial_number(number)
+        metrics_exporter = metrics_exporter_factory()
 	sys.exit(app.exec_())
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import sys
+import gobject
+import logging
+from common import CommandLine
+import traffic
+import loopbackloader
+import serviceconnector
+
+# Replays a capture recorded with --record through the handlers of the
+# recorded components, without any D-Bus traffic. The dialer needs Qt, so
+# it is only imported when the capture contains dialer events
+
+#------------------------------------------------------------------------------
+# Main
+#------------------------------------------------------------------------------
+def main():
+    # Parse arguments
+    command_line = CommandLine(
+        sys.argv, "[--fast] <capture>",
+        [ "Feeds the recorded events to new instances of the recorded",
+          "components, with the recorded timing or, with --fast, as fast as",
+          "possible, and logs how long the handlers took." ])
+    fast = command_line.take_flag("--fast")
+    command_line.finish(1)
+    if len(command_line.nonflags) != 1:
+        command_line.show_syntax_and_exit()
+    capture_path = command_line.nonflags[0]
+
+    # Create the dispatchers of the recorded components
+    try:
+        components = set(map(lambda event: event[1],
+                             traffic.read_capture(capture_path)))
+    except IOError, e:
+        logging.error("ERROR: Cannot read %s: %s" % (capture_path, e))
+        sys.exit(1)
+    dispatcher_dict = {
+        "loopback": loopbackloader.create_replay_dispatcher(),
+        "connector": serviceconnector.create_replay_dispatcher() }
+    if "dialer" in components:
+        from PyQt4 import QtGui
+        import opendialer
+        app = QtGui.QApplication(sys.argv)
+        dispatcher_dict["dialer"] = opendialer.create_replay_dispatcher()
+        quit = app.quit
+        run = app.exec_
+    else:
+        mainloop = gobject.MainLoop()
+        quit = mainloop.quit
+        run = mainloop.run
+
+    # Run main loop until the capture is over
+    def finished():
+        replayer.report()
+        quit()
+    replayer = traffic.TrafficReplayer(
+        capture_path, dispatcher_dict, fast, finished)
+    replayer.start()
+    try:
+        run()
+    except KeyboardInterrupt:
+        print
+        replayer.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1001 @@
+#!/usr/bin/env python
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import sys
+import os
+import signal
+import time
+import random
+import dbus
+import dbus.mainloop.glib
+import gobject
+import logging
+from common import CommandLine, run_main_loop, watch_name_owner
+import metrics
+import traffic
+import config
+
+command_line_syntax = (
+    "[-a, --all] [--bluez=4|5|auto] [--session-bus] [--stats-file=<path>]")
+command_line_notes = [
+    "Devices are connected in the given order of priority. With --all,",
+    "any other paired device is also connected, after the given ones.",
+    "Without addresses, the first known device is used.",
+    "SIGUSR1 logs the connection time statistics." ]
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+def get_default_adapter(bus):
+    try:
+        manager = dbus.Interface(
+            bus.get_object("org.bluez", "/"), "org.bluez.Manager")
+        adapter_path = manager.DefaultAdapter()
+        return dbus.Interface(
+            bus.get_object("org.bluez", adapter_path),
+            "org.bluez.Adapter")
+    except dbus.exceptions.DBusException:
+        return None # BlueZ not found
+
+#------------------------------------------------------------------------------
+# ConnectionStats
+#------------------------------------------------------------------------------
+class ConnectionStats:
+    # Per interface histograms of the number of Connect attempts and of the
+    # time it took to get connected, optionally rewritten to a file after
+    # every connection
+    attempt_buckets = [ 1, 2, 3, 5, 10, 20 ]
+    time_buckets = [ 1, 2, 5, 10, 20, 30, 60, 120, 300 ]
+
+    def __init__(self, stats_file=None):
+        self.stats_file = stats_file
+        self.start_time = time.time()
+        self.interface_names = set()
+        self.attempt_counter = metrics.registry.counter(
+            "service_connector_connect_attempts_total",
+            "Connect calls sent to BlueZ")
+        self.attempt_histogram = metrics.registry.histogram(
+            "service_connector_connect_attempts",
+            "Connect calls needed to get connected",
+            self.attempt_buckets)
+        self.time_histogram = metrics.registry.histogram(
+            "service_connector_time_to_connect_seconds",
+            "Time from enabling an interface until it got connected",
+            self.time_buckets, "s")
+
+    def log_stage(self, device_path, interface_name, stage):
+        logging.debug("[+%.3fs] %s %s: %s" % (
+            time.time() - self.start_time, device_path, interface_name or "",
+            stage))
+
+    def add_attempt(self, interface_name):
+        self.attempt_counter.inc(interface=interface_name)
+
+    def add_connection(self, interface_name, attempts, elapsed):
+        self.interface_names.add(interface_name)
+        self.attempt_histogram.add(attempts, interface=interface_name)
+        self.time_histogram.add(elapsed, interface=interface_name)
+        if self.stats_file != None:
+            self.write_file()
+
+    def describe(self):
+        lines = []
+        for interface_name in sorted(self.interface_names):
+            lines.append("%s attempts: %s" % (
+                interface_name,
+                self.attempt_histogram.describe(interface=interface_name)))
+            lines.append("%s time-to-connect: %s" % (
+                interface_name,
+                self.time_histogram.describe(interface=interface_name)))
+        return lines
+
+    def dump(self):
+        logging.info("Connection statistics (uptime %d s):" % (
+            time.time() - self.start_time))
+        for line in self.describe():
+            logging.info("  %s" % line)
+
+    def write_file(self):
+        try:
+            temp_file = self.stats_file + ".tmp"
+            f = open(temp_file, "w")
+            f.write("\n".join(self.describe()) + "\n")
+            f.close()
+            os.rename(temp_file, self.stats_file)
+        except (IOError, OSError), e:
+            logging.warning("Cannot write %s: %s" % (self.stats_file, e))
+
+#------------------------------------------------------------------------------
+# ConnectScheduler
+#------------------------------------------------------------------------------
+class ConnectScheduler:
+    # Connection attempts compete for the Bluetooth radio and make each other
+    # fail, so only one Connect is in flight at a time. Among the connectors
+    # whose retry delay already expired, the highest priority one goes first
+
+    def __init__(self):
+        self.waiting_connectors = []
+        self.current_connector = None
+        self.timeout_id = None
+
+    def request(self, connector):
+        if connector not in self.waiting_connectors:
+            self.waiting_connectors.append(connector)
+        self.schedule()
+
+    def cancel(self, connector):
+        if connector in self.waiting_connectors:
+            self.waiting_connectors.remove(connector)
+        self.schedule()
+
+    def finished(self, connector):
+        if self.current_connector == connector:
+            self.current_connector = None
+        self.schedule()
+
+    def schedule(self):
+        # Returns false to be used with timeout_add
+        if self.timeout_id != None:
+            gobject.source_remove(self.timeout_id)
+            self.timeout_id = None
+        if self.current_connector != None or len(self.waiting_connectors) == 0:
+            return False
+        now = time.time()
+        ready_connectors = filter(
+            lambda c: c.next_attempt_time <= now, self.waiting_connectors)
+        if len(ready_connectors) == 0:
+            next_time = min(map(
+                lambda c: c.next_attempt_time, self.waiting_connectors))
+            self.timeout_id = gobject.timeout_add(
+                int((next_time - now) * 1000) + 1, self.timeout_expired)
+            return False
+        ready_connectors.sort(key=lambda c: c.priority)
+        connector = ready_connectors[0]
+        self.waiting_connectors.remove(connector)
+        self.current_connector = connector
+        connector.do_connect()
+        return False
+
+    def timeout_expired(self):
+        self.timeout_id = None
+        return self.schedule()
+
+#------------------------------------------------------------------------------
+# InterfaceConnector
+#------------------------------------------------------------------------------
+class InterfaceConnector:
+    connect_initial_delay = 0.5
+    connect_retry_delay = 2.0 # Doubles with every failure...
+    connect_max_retry_delay = 60.0 # ...up to this
+    connect_retry_jitter = 0.25 # Random +/- fraction of each delay
+    connect_timeout = 20.0
+
+    def __init__(self, device_path, interface_name, priority, scheduler,
+                 backend, stats):
+        self.device_path = device_path
+        self.interface_name = interface_name
+        self.priority = priority # Lower goes first
+        self.scheduler = scheduler
+        self.backend = backend
+        self.stats = stats
+        self.enabled = False
+        self.failures = 0
+        self.next_attempt_time = 0
+        self.enable_time = None # Set while trying to get connected
+        self.attempts = 0
+
+    def enable(self):
+        # Returns false to be used with timeout_add
+        if self.enabled:
+            return False
+        self.enabled = True
+        logging.debug("Enabling connector %s" % self.interface_name)
+        self.stats.log_stage(self.device_path, self.interface_name, "enabled")
+        self.enable_time = time.time()
+        self.attempts = 0
+        self.failures = 0
+        self.next_attempt_time = time.time() + self.connect_initial_delay
+        self.scheduler.request(self)
+        return False
+
+    def disable(self):
+        # Returns false to be used with timeout_add
+        if self.enabled:
+            logging.debug("Disabling connector %s" % self.interface_name)
+        self.enabled = False
+        self.scheduler.cancel(self)
+        return False
+
+    def state_connected(self):
+        if self.enable_time != None:
+            elapsed = time.time() - self.enable_time
+            self.stats.log_stage(
+                self.device_path, self.interface_name,
+                "connected after %d attempts, %.3f s" % (
+                    self.attempts, elapsed))
+            self.stats.add_connection(
+                self.interface_name, self.attempts, elapsed)
+            self.enable_time = None
+        self.disable()
+
+    def reset_backoff(self):
+        # Something changed on the device, so retry right away
+        if not(self.enabled) or self.failures == 0:
+            return
+        logging.debug("Resetting backoff of %s" % self.interface_name)
+        self.failures = 0
+        self.next_attempt_time = time.time()
+        self.scheduler.request(self)
+
+    def get_retry_delay(self):
+        delay = min(self.connect_retry_delay * (2 ** (self.failures - 1)),
+                    self.connect_max_retry_delay)
+        jitter = random.uniform(
+            -self.connect_retry_jitter, self.connect_retry_jitter)
+        return delay * (1.0 + jitter)
+
+    def do_connect(self):
+        # Called by the scheduler, which waits for on_reply or on_error
+        if not(self.enabled):
+            self.scheduler.finished(self)
+            return
+        self.attempts += 1
+        if self.attempts == 1:
+            stage = "first Connect attempt"
+        else:
+            stage = "Connect retry %d" % (self.attempts - 1)
+        self.stats.log_stage(self.device_path, self.interface_name, stage)
+        self.stats.add_attempt(self.interface_name)
+        try:
+            self.backend.connect(
+                self.device_path, self.interface_name,
+                reply_handler=traffic.wrap_handler(
+                    "connector", "connect_reply", self.on_reply,
+                    self.device_path, self.interface_name),
+                error_handler=traffic.wrap_handler(
+                    "connector", "connect_error", self.on_error,
+                    self.device_path, self.interface_name),
+                timeout=self.connect_timeout)
+        except dbus.exceptions.DBusException:
+            self.on_error(None)
+
+    def on_reply(self):
+        self.failures = 0
+        self.disable()
+        self.scheduler.finished(self)
+
+    def on_error(self, error):
+        self.failures += 1
+        if self.enabled:
+            delay = self.get_retry_delay()
+            logging.debug("Connect %s failed. Retrying after %.1f secs" % (
+                self.interface_name, delay))
+            self.next_attempt_time = time.time() + delay
+            self.scheduler.request(self)
+        self.scheduler.finished(self)
+
+for (attribute, parse) in [
+    ("connect_initial_delay", config.parse_float(0)),
+    ("connect_retry_delay", config.parse_float(0.1)),
+    ("connect_max_retry_delay", config.parse_float(0.1)),
+    ("connect_retry_jitter", config.parse_float(0, 0.9)),
+    ("connect_timeout", config.parse_float(1)) ]:
+    config.register("connector", InterfaceConnector, attribute, parse)
+
+#------------------------------------------------------------------------------
+# DeviceConnector
+#------------------------------------------------------------------------------
+class DeviceConnector:
+    enabled_interfaces = [ "HandsfreeGateway", "AudioSource" ] # By priority
+
+    def __init__(self, device_address, priority, connect_scheduler, backend,
+                 stats):
+        assert(device_address != None)
+        self.device_address = device_address
+        self.priority = priority # Lower goes first
+        self.connect_scheduler = connect_scheduler
+        self.backend = backend
+        self.stats = stats
+        self.device_path = None
+        self.interface_connector_dict = dict()
+
+    def device_found(self, path):
+        self.stats.log_stage(
+            path, None, "path resolved for %s" % self.device_address)
+        self.device_path = path
+        self.init_interface_connectors()
+        self.poll_device_properties(False)
+
+    def device_lost(self):
+        self.device_path = None # Needs to be updated
+        self.shutdown_interface_connectors()
+
+    def init_interface_connectors(self):
+        # This method assumes that self.device_path is valid (updated)
+        assert(self.device_path != None)
+        self.shutdown_interface_connectors()
+        for (priority, enabled_interface) in enumerate(self.enabled_interfaces):
+            full_interface_name = "org.bluez." + enabled_interface
+            self.interface_connector_dict[full_interface_name] = (
+                InterfaceConnector(self.device_path, full_interface_name,
+                                   (self.priority, priority),
+                                   self.connect_scheduler, self.backend,
+                                   self.stats))
+
+    def shutdown_interface_connectors(self):
+        for interface_connector in self.interface_connector_dict.values():
+            interface_connector.disable()
+        self.interface_connector_dict = dict()
+
+    def poll_device_properties(self, also_poll_device_interface):
+        assert(self.device_path != None)
+        observed_interfaces = list(self.interface_connector_dict.keys())
+        if also_poll_device_interface:
+            observed_interfaces += [ "org.bluez.Device" ]
+        self.backend.poll_properties(self.device_path, observed_interfaces)
+
+    def process_property(
+        self, property_name, property_value, path, interface):
+        # The ServiceConnector only forwards properties of our device
+        if path != self.device_path:
+            return
+        # Handle the registration (or removal) of interfaces
+        if interface == "org.bluez.Device" and property_name == "UUIDs":
+            self.poll_device_properties(False)
+            return
+        # The device just showed up (or got paired), so it is worth trying
+        # immediately instead of waiting for the backoff to expire
+        if (interface == "org.bluez.Device" and
+            property_name in [ "Connected", "Paired" ] and
+            bool(property_value)):
+            for interface_connector in self.interface_connector_dict.values():
+                interface_connector.reset_backoff()
+            return
+        # If some interface changed it connected state, update the appropriate
+        # InterfaceConnector accordingly
+        if property_name == "State":
+            if self.interface_connector_dict.has_key(interface):
+                interface_connector = self.interface_connector_dict[interface]
+                if property_value != "disconnected":
+                    interface_connector.state_connected()
+                else:
+                    interface_connector.enable()
+
+#------------------------------------------------------------------------------
+# BluezBackend
+#------------------------------------------------------------------------------
+class BluezBackend:
+    # Base class of the BlueZ version specific code. Everything is reported
+    # to the listener (the ServiceConnector) in BlueZ 4 terms, through:
+    #
+    #   backend_reset()
+    #   device_added(path, device_properties)
+    #   device_removed(path)
+    #   process_property(property_name, property_value, path, interface)
+    #
+    # where interface is "org.bluez.Device" or one of the profile interfaces
+    # ("org.bluez.HandsfreeGateway"...), whose connection state is reported
+    # through their "State" property.
+    name = None
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.listener = None
+
+    def start(self, listener):
+        self.listener = listener
+
+    def request_devices(self, device_addresses, list_all):
+        # Report the given devices, or every known device if list_all
+        pass
+
+    def probe_device(self, path):
+        # Report the device if it exists
+        pass
+
+    def poll_properties(self, path, interface_names):
+        # Report the properties of the given interfaces of the device
+        pass
+
+    def connect(self, path, interface_name, reply_handler, error_handler,
+                timeout):
+        error_handler("Connect is not supported by %s" % self.name)
+
+#------------------------------------------------------------------------------
+# Bluez4Backend
+#------------------------------------------------------------------------------
+class Bluez4Backend(BluezBackend):
+    # Device paths do not say which address they belong to, so the address
+    # (and pairing state) of each path is cached. The cache is seeded from
+    # the Devices of the adapter when it is found, extended on DeviceCreated
+    # and kept current through signals: every path is queried at most once
+    name = "bluez4"
+    cached_properties = [ "Address", "Paired" ]
+
+    def start(self, listener):
+        BluezBackend.start(self, listener)
+        self.invalidate_device_cache()
+        watch_name_owner(self.bus, "org.bluez", self.name_owner_changed)
+        self.bus.add_signal_receiver(
+            self.probe_device,
+            dbus_interface="org.bluez.Adapter",
+            signal_name="DeviceCreated")
+        self.bus.add_signal_receiver(
+            self.device_removed,
+            dbus_interface="org.bluez.Adapter",
+            signal_name="DeviceRemoved")
+        self.bus.add_signal_receiver(
+            self.device_property_changed,
+            dbus_interface="org.bluez.Device",
+            signal_name="PropertyChanged",
+            path_keyword="path")
+        for observed_interface in DeviceConnector.enabled_interfaces:
+            self.bus.add_signal_receiver(
+                self.listener.process_property,
+                dbus_interface="org.bluez." + observed_interface,
+                signal_name="PropertyChanged",
+                path_keyword="path",
+                interface_keyword="interface")
+
+    def invalidate_device_cache(self):
+        self.device_cache = dict() # Path -> cached device properties
+        self.pending_probes = set() # Paths being queried
+        self.device_cache_seeded = False
+        self.device_cache_seeding = False
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        self.invalidate_device_cache()
+        self.listener.backend_reset()
+
+    def device_removed(self, path):
+        if self.device_cache.has_key(path):
+            del self.device_cache[path]
+            self.listener.device_removed(path)
+
+    def device_property_changed(self, property_name, property_value, path):
+        if (self.device_cache.has_key(path) and
+            property_name in self.cached_properties):
+            self.device_cache[path][property_name] = property_value
+        self.listener.process_property(
+            property_name, property_value, path, "org.bluez.Device")
+
+    def request_devices(self, device_addresses, list_all):
+        # Once seeded, the cache knows every device of the adapter, and
+        # DeviceCreated reports the new ones, so no need to ask BlueZ
+        if self.device_cache_seeded:
+            for (path, properties) in self.device_cache.items():
+                if list_all or properties["Address"] in device_addresses:
+                    self.probe_device(path)
+            return
+        self.seed_device_cache()
+
+    def seed_device_cache(self):
+        # Probes every device of the adapter, each probe reporting its device
+        if self.device_cache_seeding:
+            return
+        adapter = get_default_adapter(self.bus)
+        if adapter == None:
+            return
+        def properties_response(properties):
+            self.device_cache_seeding = False
+            self.device_cache_seeded = True
+            for path in properties.get("Devices", []):
+                self.probe_device(path)
+        def properties_error(error):
+            self.device_cache_seeding = False
+        self.device_cache_seeding = True
+        adapter.GetProperties(
+            reply_handler=properties_response,
+            error_handler=properties_error)
+
+    def probe_device(self, path):
+        if self.device_cache.has_key(path):
+            # Local lookup, no need to ask BlueZ again
+            self.listener.device_added(path, dict(self.device_cache[path]))
+            return
+        if path in self.pending_probes:
+            return # The reply will be reported anyway
+        self.pending_probes.add(path)
+        def probe_response(properties):
+            self.pending_probes.discard(path)
+            if not properties.has_key("Address"):
+                return
+            self.device_cache[path] = dict(map(
+                lambda key: (key, properties.get(key)),
+                self.cached_properties))
+            self.listener.device_added(path, properties)
+        def probe_error(error):
+            self.pending_probes.discard(path)
+        interface = dbus.Interface(
+            self.bus.get_object("org.bluez", path), "org.bluez.Device")
+        interface.GetProperties(
+            reply_handler=probe_response,
+            error_handler=probe_error)
+
+    def poll_properties(self, path, interface_names):
+        for interface_name in interface_names:
+            self.poll_interface_properties(path, interface_name)
+
+    def poll_interface_properties(self, path, interface_name):
+        interface = dbus.Interface(
+            self.bus.get_object("org.bluez", path), interface_name)
+        try:
+            interface.GetProperties(
+                reply_handler=lambda props:
+                    self.poll_interface_properties_response(
+                    path, interface_name, props),
+                error_handler=lambda e: None)
+        except dbus.exceptions.DBusException:
+            # Interface might not be available
+            return
+
+    def poll_interface_properties_response(self, path, interface, properties):
+        for (key, value) in properties.items():
+            self.listener.process_property(key, value, path, interface)
+
+    def connect(self, path, interface_name, reply_handler, error_handler,
+                timeout):
+        interface = dbus.Interface(
+            self.bus.get_object("org.bluez", path), interface_name)
+        interface.Connect(
+            reply_handler=reply_handler,
+            error_handler=error_handler,
+            timeout=timeout)
+
+#------------------------------------------------------------------------------
+# Bluez5Backend
+#------------------------------------------------------------------------------
+class Bluez5Backend(BluezBackend):
+    # BlueZ 5 exports every object through the ObjectManager, so one
+    # GetManagedObjects call gives the complete view, which is then kept up
+    # to date through InterfacesAdded, InterfacesRemoved and
+    # PropertiesChanged. Profiles are connected through ConnectProfile, and
+    # considered connected until the device disconnects (or, for A2DP,
+    # while a media transport exists)
+    name = "bluez5"
+    profile_uuid_dict = {
+        "org.bluez.HandsfreeGateway": "0000111f-0000-1000-8000-00805f9b34fb",
+        "org.bluez.AudioSource": "0000110a-0000-1000-8000-00805f9b34fb" }
+    a2dp_uuids = [ "0000110a-0000-1000-8000-00805f9b34fb",
+                   "0000110b-0000-1000-8000-00805f9b34fb" ]
+
+    def start(self, listener):
+        BluezBackend.start(self, listener)
+        self.invalidate_objects()
+        watch_name_owner(self.bus, "org.bluez", self.name_owner_changed)
+        self.bus.add_signal_receiver(
+            self.interfaces_added,
+            bus_name="org.bluez",
+            dbus_interface="org.freedesktop.DBus.ObjectManager",
+            signal_name="InterfacesAdded")
+        self.bus.add_signal_receiver(
+            self.interfaces_removed,
+            bus_name="org.bluez",
+            dbus_interface="org.freedesktop.DBus.ObjectManager",
+            signal_name="InterfacesRemoved")
+        self.bus.add_signal_receiver(
+            self.properties_changed,
+            bus_name="org.bluez",
+            dbus_interface="org.freedesktop.DBus.Properties",
+            signal_name="PropertiesChanged",
+            path_keyword="path")
+
+    def invalidate_objects(self):
+        self.object_dict = dict() # Path -> interface -> properties
+        self.connected_profiles = set() # (device path, interface name)
+        self.snapshot_ready = False
+        self.snapshot_pending = False
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        self.invalidate_objects()
+        self.listener.backend_reset()
+
+    def request_devices(self, device_addresses, list_all):
+        # Every device is reported anyway, the listener filters them
+        if self.snapshot_ready:
+            self.report_devices()
+            return
+        if self.snapshot_pending:
+            return
+        def objects_response(objects):
+            self.snapshot_pending = False
+            for (path, interfaces) in objects.items():
+                self.interfaces_added(path, interfaces, False)
+                transport = interfaces.get("org.bluez.MediaTransport1")
+                if transport != None and transport.get("UUID") in (
+                    self.a2dp_uuids):
+                    self.connected_profiles.add(
+                        (self.get_device_path(path), "org.bluez.AudioSource"))
+            self.snapshot_ready = True
+            self.report_devices()
+        def objects_error(error):
+            self.snapshot_pending = False
+        try:
+            object_manager = dbus.Interface(
+                self.bus.get_object("org.bluez", "/"),
+                "org.freedesktop.DBus.ObjectManager")
+            self.snapshot_pending = True
+            object_manager.GetManagedObjects(
+                reply_handler=objects_response,
+                error_handler=objects_error)
+        except dbus.exceptions.DBusException:
+            self.snapshot_pending = False # BlueZ not running
+
+    def report_devices(self):
+        for (path, interfaces) in self.object_dict.items():
+            if interfaces.has_key("org.bluez.Device1"):
+                self.listener.device_added(
+                    path, interfaces["org.bluez.Device1"])
+
+    def probe_device(self, path):
+        device_properties = self.object_dict.get(path, dict()).get(
+            "org.bluez.Device1")
+        if device_properties != None:
+            self.listener.device_added(path, device_properties)
+
+    def get_device_path(self, path):
+        # Media transports and other objects live below their device
+        while path.count("/") > 4:
+            path = path[:path.rindex("/")]
+        return path
+
+    def interfaces_added(self, path, interfaces, report=True):
+        object_interfaces = self.object_dict.setdefault(path, dict())
+        for (interface_name, properties) in interfaces.items():
+            object_interfaces[interface_name] = dict(properties)
+        if not report:
+            return
+        if interfaces.has_key("org.bluez.Device1"):
+            self.listener.device_added(path, interfaces["org.bluez.Device1"])
+        if interfaces.has_key("org.bluez.MediaTransport1"):
+            transport = interfaces["org.bluez.MediaTransport1"]
+            if transport.get("UUID") in self.a2dp_uuids:
+                self.set_profile_state(
+                    self.get_device_path(path), "org.bluez.AudioSource",
+                    "connected")
+
+    def interfaces_removed(self, path, interface_names):
+        object_interfaces = self.object_dict.get(path, dict())
+        removed = dict()
+        for interface_name in interface_names:
+            if object_interfaces.has_key(interface_name):
+                removed[interface_name] = object_interfaces.pop(interface_name)
+        if len(object_interfaces) == 0:
+            self.object_dict.pop(path, None)
+        if removed.has_key("org.bluez.Device1"):
+            for (device_path, interface_name) in list(self.connected_profiles):
+                if device_path == path:
+                    self.connected_profiles.discard((path, interface_name))
+            self.listener.device_removed(path)
+        if removed.has_key("org.bluez.MediaTransport1"):
+            if removed["org.bluez.MediaTransport1"].get("UUID") in (
+                self.a2dp_uuids):
+                self.set_profile_state(
+                    self.get_device_path(path), "org.bluez.AudioSource",
+                    "disconnected")
+
+    def properties_changed(self, interface_name, changed, invalidated, path):
+        object_interfaces = self.object_dict.get(path)
+        if object_interfaces == None:
+            return
+        properties = object_interfaces.setdefault(interface_name, dict())
+        properties.update(changed)
+        for property_name in invalidated:
+            properties.pop(property_name, None)
+        if interface_name != "org.bluez.Device1":
+            return
+        for (property_name, property_value) in changed.items():
+            self.listener.process_property(
+                property_name, property_value, path, "org.bluez.Device")
+        if changed.has_key("Connected") and not bool(changed["Connected"]):
+            for profile_interface in self.profile_uuid_dict.keys():
+                self.set_profile_state(path, profile_interface, "disconnected")
+
+    def set_profile_state(self, path, interface_name, state):
+        key = (path, interface_name)
+        if state == "connected":
+            if key in self.connected_profiles:
+                return
+            self.connected_profiles.add(key)
+        else:
+            if key not in self.connected_profiles:
+                return
+            self.connected_profiles.discard(key)
+        self.listener.process_property("State", state, path, interface_name)
+
+    def poll_properties(self, path, interface_names):
+        device_properties = self.object_dict.get(path, dict()).get(
+            "org.bluez.Device1")
+        if device_properties == None:
+            return
+        for interface_name in interface_names:
+            if interface_name == "org.bluez.Device":
+                for (key, value) in device_properties.items():
+                    self.listener.process_property(key, value, path,
+                                                   interface_name)
+                continue
+            # Like in BlueZ 4, profiles the device lacks have no state
+            uuid = self.profile_uuid_dict.get(interface_name)
+            if uuid not in map(lambda u: str(u).lower(),
+                               device_properties.get("UUIDs", [])):
+                continue
+            state = "disconnected"
+            if (path, interface_name) in self.connected_profiles:
+                state = "connected"
+            self.listener.process_property("State", state, path,
+                                           interface_name)
+
+    def connect(self, path, interface_name, reply_handler, error_handler,
+                timeout):
+        def connect_response():
+            self.set_profile_state(path, interface_name, "connected")
+            reply_handler()
+        def connect_error(error):
+            if (isinstance(error, dbus.exceptions.DBusException) and
+                error.get_dbus_name() == "org.bluez.Error.AlreadyConnected"):
+                connect_response()
+            else:
+                error_handler(error)
+        device = dbus.Interface(
+            self.bus.get_object("org.bluez", path), "org.bluez.Device1")
+        device.ConnectProfile(
+            self.profile_uuid_dict[interface_name],
+            reply_handler=connect_response,
+            error_handler=connect_error,
+            timeout=timeout)
+
+#------------------------------------------------------------------------------
+# ReplayBackend
+#------------------------------------------------------------------------------
+class ReplayBackend(BluezBackend):
+    # Everything reported to the ServiceConnector, and the replies to its
+    # Connect calls, come from a traffic capture through the replay
+    # dispatcher. Replies may come before the call, as the retry timers do
+    # not follow the recorded timing
+    name = "replay"
+
+    def __init__(self):
+        BluezBackend.__init__(self, None)
+        self.handler_dict = dict() # (path, interface) -> handlers
+        self.reply_dict = dict() # (path, interface) -> early error or None
+
+    def connect(self, path, interface_name, reply_handler, error_handler,
+                timeout):
+        key = (path, interface_name)
+        if self.reply_dict.has_key(key):
+            self.call_handler((reply_handler, error_handler),
+                              self.reply_dict.pop(key))
+        else:
+            self.handler_dict[key] = (reply_handler, error_handler)
+
+    def deliver_reply(self, path, interface_name, error=None):
+        key = (path, interface_name)
+        if self.handler_dict.has_key(key):
+            self.call_handler(self.handler_dict.pop(key), error)
+        else:
+            self.reply_dict[key] = error
+
+    def call_handler(self, (reply_handler, error_handler), error):
+        if error == None:
+            reply_handler()
+        else:
+            error_handler(error)
+
+def detect_bluez_backend(bus):
+    # BlueZ 4 has its Manager on the root object, BlueZ 5 the ObjectManager
+    try:
+        introspectable = dbus.Interface(
+            bus.get_object("org.bluez", "/"),
+            "org.freedesktop.DBus.Introspectable")
+        if "org.bluez.Manager" in introspectable.Introspect():
+            return Bluez4Backend
+    except dbus.exceptions.DBusException:
+        pass # BlueZ not running yet, so assume a current one
+    return Bluez5Backend
+
+#------------------------------------------------------------------------------
+# ServiceConnector
+#------------------------------------------------------------------------------
+class ServiceConnector:
+    # Keeps one DeviceConnector per phone, all of them sharing the signal
+    # subscriptions and a single ConnectScheduler. Devices get priorities in
+    # the order they are added: explicitly given addresses first, then other
+    # known devices as reported by the backend, up to max_other_devices
+    # (None meaning any number of paired devices)
+
+    def __init__(self, device_addresses, max_other_devices, backend, stats):
+        self.device_addresses = list(device_addresses)
+        self.max_other_devices = max_other_devices
+        self.backend = backend
+        self.stats = stats
+        self.connect_scheduler = ConnectScheduler()
+        self.device_connector_dict = dict() # Address -> DeviceConnector
+        self.path_dict = dict() # Device path -> DeviceConnector
+        for device_address in device_addresses:
+            self.add_device(device_address)
+        traffic.record(
+            "connector", "start", device_addresses, max_other_devices)
+        self.backend.start(traffic.wrap_listener("connector", self))
+        self.request_devices()
+
+    def request_devices(self):
+        self.stats.log_stage("-", None, "looking up devices")
+        self.backend.request_devices(
+            self.device_addresses, self.max_other_devices != 0)
+
+    def add_device(self, device_address):
+        if self.device_connector_dict.has_key(device_address):
+            return self.device_connector_dict[device_address]
+        logging.info("Managing device %s" % device_address)
+        device_connector = DeviceConnector(
+            device_address, len(self.device_connector_dict),
+            self.connect_scheduler, self.backend, self.stats)
+        self.device_connector_dict[device_address] = device_connector
+        return device_connector
+
+    def backend_reset(self):
+        self.path_dict = dict()
+        for device_connector in self.device_connector_dict.values():
+            device_connector.device_lost()
+        self.request_devices()
+
+    def may_add_other_device(self, device_properties):
+        if self.max_other_devices == None:
+            # Only paired devices when managing all of them
+            return bool(device_properties.get("Paired"))
+        other_devices = (
+            len(self.device_connector_dict) - len(self.device_addresses))
+        return other_devices < self.max_other_devices
+
+    def device_added(self, path, device_properties):
+        if self.path_dict.has_key(path):
+            return
+        if not(device_properties.has_key("Address")):
+            return
+        device_address = str(device_properties["Address"])
+        device_connector = self.device_connector_dict.get(device_address)
+        if device_connector == None:
+            if not(self.may_add_other_device(device_properties)):
+                return
+            device_connector = self.add_device(device_address)
+        # Device found
+        if device_connector.device_path != None:
+            self.path_dict.pop(device_connector.device_path, None)
+        self.path_dict[path] = device_connector
+        device_connector.device_found(path)
+        for (key, value) in device_properties.items():
+            # device_found already polled the interfaces the UUIDs announce
+            if key == "UUIDs":
+                continue
+            device_connector.process_property(
+                key, value, path, "org.bluez.Device")
+
+    def device_removed(self, path):
+        device_connector = self.path_dict.pop(path, None)
+        if device_connector != None:
+            device_connector.device_lost()
+
+    def is_device_missing(self):
+        if self.max_other_devices != 0:
+            return True
+        return len(self.path_dict) < len(self.device_connector_dict)
+
+    def process_property(
+        self, property_name, property_value, path, interface):
+        # Dispatch to the connector owning the path
+        device_connector = self.path_dict.get(path)
+        if device_connector != None:
+            device_connector.process_property(
+                property_name, property_value, path, interface)
+            return
+        # Detect device creation (or registration) of one of our devices
+        if (interface == "org.bluez.Device" and property_name == "Paired" and
+            self.is_device_missing()):
+            self.backend.probe_device(path)
+
+    def dump_status(self):
+        logging.info("Backend: %s" % self.backend.name)
+        for device_connector in sorted(self.device_connector_dict.values(),
+                                       key=lambda c: c.priority):
+            logging.info("Device %s: %s" % (
+                device_connector.device_address,
+                device_connector.device_path or "(not found)"))
+        self.stats.dump()
+
+def create_replay_dispatcher():
+    # Dispatcher of the "connector" events of a traffic capture, creating
+    # the ServiceConnector on the "start" event
+    state = dict()
+    def dispatch(event, args, kwargs):
+        if event == "start":
+            state["backend"] = ReplayBackend()
+            state["connector"] = ServiceConnector(
+                args[0], args[1], state["backend"], ConnectionStats())
+        elif not state.has_key("connector"):
+            return # Started before the capture
+        elif event in [ "connect_reply", "connect_error" ]:
+            state["backend"].deliver_reply(*args)
+        else:
+            getattr(state["connector"], event)(*args, **kwargs)
+    dispatch.state = state # For the tests
+    return dispatch
+
+#------------------------------------------------------------------------------
+# Main
+#------------------------------------------------------------------------------
+def create_service_connector(command_line, device_addresses):
+    # Takes the options of the service-connector from the command line
+    all_paired_devices = command_line.take_flag("-a", "--all")
+    # The session bus is mostly useful with fake-bluez
+    use_session_bus = command_line.take_flag("--session-bus")
+    backend_name = command_line.take_value(
+        "--bluez", "auto", choices=[ "4", "5", "auto" ])
+    stats_file = command_line.take_value("--stats-file")
+    def factory():
+        if use_session_bus:
+            bus = dbus.SessionBus()
+        else:
+            bus = dbus.SystemBus()
+        if backend_name == "4":
+            backend = Bluez4Backend(bus)
+        elif backend_name == "5":
+            backend = Bluez5Backend(bus)
+        else:
+            backend = detect_bluez_backend(bus)(bus)
+        logging.debug("Using %s" % backend.name)
+        # Choose an arbitrary device if none given
+        max_other_devices = 0
+        if all_paired_devices:
+            max_other_devices = None
+        elif len(device_addresses) == 0:
+            logging.info("Device address not given, so picking first device...")
+            max_other_devices = 1
+        return ServiceConnector(
+            device_addresses, max_other_devices, backend,
+            ConnectionStats(stats_file))
+    return factory
+
+def main():
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    # Parse arguments
+    command_line = CommandLine(
+        sys.argv,
+        command_line_syntax + " " + metrics.command_line_syntax + " " +
+        traffic.command_line_syntax + " " + config.command_line_syntax +
+        " [<bt-address>...]",
+        command_line_notes)
+    service_connector_factory = create_service_connector(
+        command_line, command_line.nonflags)
+    metrics_exporter_factory = metrics.create_metrics_exporter(command_line)
+    record_path = command_line.take_value("--record")
+    config_factory = config.create_config(command_line)
+    command_line.finish()
+    traffic.start_recording(record_path)
+    runtime_config = config_factory()
+
+    # Run main loop
+    service_connector = service_connector_factory()
+    metrics_exporter = metrics_exporter_factory()
+    signal.signal(
+        signal.SIGUSR1, lambda signum, frame: service_connector.dump_status())
+    run_main_loop()
+
+if __name__ == "__main__":
+    main()
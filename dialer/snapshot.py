@@ -0,0 +1,82 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import json
+import logging
+
+# The calls of the dialer as last shown, so that a restarted dialer can
+# show them right away while it asks oFono for the real state. A snapshot
+# is a single JSON object:
+#
+#   { "modem": <modem path>,
+#     "modem_properties": { "Powered": ..., "Name": ..., "Serial": ... },
+#     "calls": [ [<call path>, <call properties>], ... ],
+#     "displays": [ <call path or null>, ... ] }
+#
+# It is written to a temporary file renamed over the previous one, so that
+# a crash never leaves half a snapshot behind. Writing is skipped when
+# nothing changed. The default location is in XDG_RUNTIME_DIR, usually a
+# tmpfs, as calls do not survive a reboot anyway
+
+#------------------------------------------------------------------------------
+# CallSnapshot
+#------------------------------------------------------------------------------
+class CallSnapshot:
+    def __init__(self, path):
+        self.path = path
+        self.last_text = None
+
+    def load(self, modem_path=None):
+        # Returns the snapshot of the given modem (of any modem if None), or
+        # None
+        try:
+            snapshot_file = open(self.path)
+            try:
+                text = snapshot_file.read()
+            finally:
+                snapshot_file.close()
+            snapshot = json.loads(text)
+        except (IOError, ValueError), e:
+            logging.debug("No call snapshot: %s" % e)
+            return None
+        if not isinstance(snapshot, dict) or (
+            not isinstance(snapshot.get("modem"), basestring)):
+            return None
+        if modem_path != None and snapshot["modem"] != modem_path:
+            return None
+        self.last_text = text
+        return snapshot
+
+    def save(self, snapshot):
+        text = json.dumps(snapshot, separators=(",", ":"), sort_keys=True)
+        if text == self.last_text:
+            return
+        try:
+            temp_file = self.path + ".tmp"
+            f = open(temp_file, "w")
+            f.write(text)
+            f.close()
+            os.rename(temp_file, self.path)
+            self.last_text = text
+        except (IOError, OSError), e:
+            logging.warning("Cannot write %s: %s" % (self.path, e))
+
+default_path = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR", "/tmp"),
+    "opendialer-calls-%d.json" % os.getuid())
@@ -0,0 +1,196 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import time
+import json
+import dbus
+import gobject
+import logging
+
+# Recording of the traffic that drives each component: the signals and the
+# method replies it gets, at the point where they enter it. Every event is
+# one JSON line:
+#
+#   [<seconds since start>, <component>, <event>, <args>]
+#
+# plus a dictionary of keyword arguments when there are any. Replaying the
+# events through the same entry points reproduces the exact ordering that
+# led to a bug, and measures how fast the handlers process it.
+
+#------------------------------------------------------------------------------
+# TrafficRecorder
+#------------------------------------------------------------------------------
+def to_plain(value):
+    # D-Bus types to what JSON can hold. Booleans first, as they are ints
+    if isinstance(value, dbus.Boolean):
+        return bool(value)
+    if isinstance(value, (int, long)):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, basestring):
+        return unicode(value)
+    if isinstance(value, dict):
+        return dict(map(lambda (k, v): (to_plain(k), to_plain(v)),
+                        value.items()))
+    if isinstance(value, (list, tuple)):
+        return map(to_plain, value)
+    if value == None:
+        return None
+    return str(value) # Errors mostly
+
+class TrafficRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.start_time = time.time()
+        self.event_count = 0
+        self.capture_file = open(path, "w", 1) # Line buffered, for crashes
+
+    def record(self, component, event, args, kwargs=None):
+        entry = [ round(time.time() - self.start_time, 6), component, event,
+                  to_plain(args) ]
+        if kwargs:
+            entry.append(to_plain(kwargs))
+        self.capture_file.write(
+            json.dumps(entry, separators=(",", ":")) + "\n")
+        self.event_count += 1
+
+class RecordingListener:
+    # Forwards every method call to the listener, recording it first
+    def __init__(self, component, listener):
+        self.component = component
+        self.listener = listener
+
+    def __getattr__(self, name):
+        return wrap_handler(
+            self.component, name, getattr(self.listener, name))
+
+recorder = None # Set by start_recording()
+
+command_line_syntax = "[--record=<file>]"
+
+def start_recording(path):
+    global recorder
+    if path != None:
+        logging.info("Recording traffic to %s" % path)
+        recorder = TrafficRecorder(path)
+
+def record(component, event, *args):
+    if recorder != None:
+        recorder.record(component, event, args)
+
+def wrap_handler(component, event, handler, *context):
+    # The context arguments are recorded before the handler arguments, so
+    # that the replayer can tell which request a reply belongs to
+    if recorder == None:
+        return handler
+    def recorded_handler(*args, **kwargs):
+        recorder.record(component, event, context + args, kwargs)
+        return handler(*args, **kwargs)
+    return recorded_handler
+
+def wrap_listener(component, listener):
+    if recorder == None:
+        return listener
+    return RecordingListener(component, listener)
+
+#------------------------------------------------------------------------------
+# TrafficReplayer
+#------------------------------------------------------------------------------
+def read_capture(path):
+    capture_file = open(path)
+    for (line_number, line) in enumerate(capture_file):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            logging.warning("%s:%d: ignoring broken line" % (
+                path, line_number + 1))
+            continue
+        if len(entry) == 4:
+            entry.append(dict())
+        yield tuple(entry)
+    capture_file.close()
+
+class TrafficReplayer:
+    # Feeds the events of a capture to the dispatchers of their components,
+    # either with the recorded timing or as fast as the main loop allows.
+    # A dispatcher is called as dispatcher(event, args, kwargs)
+    def __init__(self, path, dispatcher_dict, fast, finished_callback):
+        self.events = read_capture(path)
+        self.dispatcher_dict = dispatcher_dict # Component -> dispatcher
+        self.fast = fast
+        self.finished_callback = finished_callback
+        self.start_time = None
+        self.event_count = 0
+        self.handler_time_dict = dict() # Component -> seconds spent
+        self.event_count_dict = dict() # Component -> events
+        self.next_event = None
+
+    def start(self):
+        self.start_time = time.time()
+        gobject.idle_add(self.replay_next)
+
+    def replay_next(self):
+        # Returns false to be used with idle_add and timeout_add
+        if self.next_event != None:
+            self.dispatch(self.next_event)
+            self.next_event = None
+        for event in self.events:
+            if not self.fast:
+                delay = self.start_time + event[0] - time.time()
+                if delay > 0:
+                    self.next_event = event
+                    gobject.timeout_add(int(delay * 1000), self.replay_next)
+                    return False
+            self.dispatch(event)
+            if self.fast:
+                # Let the main loop run whatever the handler scheduled
+                gobject.idle_add(self.replay_next)
+                return False
+        self.finished_callback()
+        return False
+
+    def dispatch(self, (timestamp, component, event, args, kwargs)):
+        dispatcher = self.dispatcher_dict.get(component)
+        if dispatcher == None:
+            return
+        kwargs = dict(map(lambda (k, v): (str(k), v), kwargs.items()))
+        start_time = time.time()
+        try:
+            dispatcher(event, args, kwargs)
+        except Exception, e:
+            logging.exception("Replaying %s %s failed: %s" % (
+                component, event, e))
+        self.handler_time_dict[component] = (
+            self.handler_time_dict.get(component, 0) + time.time() -
+            start_time)
+        self.event_count_dict[component] = (
+            self.event_count_dict.get(component, 0) + 1)
+        self.event_count += 1
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        logging.info("Replayed %d events in %.3f s" % (
+            self.event_count, elapsed))
+        for component in sorted(self.event_count_dict.keys()):
+            handler_time = self.handler_time_dict[component]
+            event_count = self.event_count_dict[component]
+            logging.info(
+                "  %s: %d events, %.3f s in handlers, %.0f events/s" % (
+                    component, event_count, handler_time,
+                    event_count / max(handler_time, 1e-6)))
@@ -0,0 +1,151 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import quopri
+
+# Streaming reader of vCard 2.1 and 3.0 files, as pulled from phones through
+# PBAP. Lines are read one at a time, so that large phonebooks (or a pipe)
+# are processed as they come, and every card is yielded as soon as it ends:
+#
+#   for (name, numbers) in VCardReader(open("contacts.vcf")):
+#       ...
+#
+# Folded lines (3.0) and quoted-printable soft line breaks (2.1) are joined
+# before parsing, and values are decoded according to their ENCODING and
+# CHARSET parameters.
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+def split_unescaped(value, separator):
+    # Splits on the separators not escaped with a backslash
+    if "\\" not in value:
+        if separator == None:
+            return [ value ]
+        return value.split(separator)
+    parts = [ "" ]
+    escaped = False
+    for char in value:
+        if escaped:
+            parts[-1] += { "n": "\n", "N": "\n" }.get(char, char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == separator:
+            parts.append("")
+        else:
+            parts[-1] += char
+    return parts
+
+def unescape(value):
+    return split_unescaped(value, None)[0]
+
+def parse_content_line(line):
+    # Returns (name, parameters, value) of a "group.NAME;PARAM=x:value"
+    # line. Parameters without a name (2.1 style, like "CELL") are kept as
+    # TYPE values
+    (name_part, separator, value) = line.partition(":")
+    if not separator:
+        return (None, dict(), None)
+    name_fields = name_part.split(";")
+    name = name_fields[0].split(".")[-1].upper()
+    parameters = dict()
+    for field in name_fields[1:]:
+        (parameter_name, separator, parameter_value) = field.partition("=")
+        if not separator:
+            (parameter_name, parameter_value) = ("TYPE", parameter_name)
+            if parameter_value.upper() in [ "QUOTED-PRINTABLE", "BASE64",
+                                            "8BIT", "7BIT" ]:
+                parameter_name = "ENCODING"
+        parameters.setdefault(parameter_name.upper(), []).append(
+            parameter_value.strip('"').upper())
+    return (name, parameters, value)
+
+def decode_value(value, parameters):
+    if "QUOTED-PRINTABLE" in parameters.get("ENCODING", []):
+        value = quopri.decodestring(value)
+    charset = parameters.get("CHARSET", [ "UTF-8" ])[0]
+    try:
+        return value.decode(charset, "replace")
+    except LookupError:
+        return value.decode("utf-8", "replace") # Unknown charset
+
+#------------------------------------------------------------------------------
+# VCardReader
+#------------------------------------------------------------------------------
+class VCardReader:
+    # Iterates over the (name, numbers) of the cards with at least a name.
+    # bytes_read and cards_read can be followed from another thread, to
+    # report progress
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+        self.cards_read = 0
+
+    def read_lines(self):
+        # readline() returns what is available, also on pipes
+        while True:
+            line = self.stream.readline()
+            if not line:
+                return
+            self.bytes_read += len(line)
+            yield line.rstrip("\r\n")
+
+    def read_logical_lines(self):
+        pending = None
+        for line in self.read_lines():
+            if pending != None:
+                if line[:1] in [ " ", "\t" ]:
+                    pending += line[1:] # Folded line
+                    continue
+                if (pending.endswith("=") and
+                    "QUOTED-PRINTABLE" in pending.partition(":")[0].upper()):
+                    pending = pending[:-1] + line # Soft line break
+                    continue
+                yield pending
+            pending = line
+        if pending != None:
+            yield pending
+
+    def __iter__(self):
+        name = None
+        numbers = []
+        in_card = False
+        for line in self.read_logical_lines():
+            (property_name, parameters, value) = parse_content_line(line)
+            if property_name == "BEGIN" and value.upper() == "VCARD":
+                (name, numbers, in_card) = (None, [], True)
+            elif not in_card:
+                continue
+            elif property_name == "FN":
+                name = unescape(decode_value(value, parameters)).strip() or name
+            elif property_name == "N" and name == None:
+                fields = split_unescaped(decode_value(value, parameters), ";")
+                name = " ".join(filter(None, map(
+                    lambda f: f.strip(), reversed(fields[:2])))) or None
+            elif property_name == "TEL":
+                number = decode_value(value, parameters).strip()
+                if number.lower().startswith("tel:"):
+                    number = number[4:]
+                if number:
+                    numbers.append(number)
+            elif property_name == "END" and value.upper() == "VCARD":
+                in_card = False
+                self.cards_read += 1
+                if name:
+                    yield (name, numbers)
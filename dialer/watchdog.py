@@ -0,0 +1,98 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import sys
+import thread
+import threading
+import time
+import traceback
+import gobject
+import logging
+
+#------------------------------------------------------------------------------
+# Watchdog
+#------------------------------------------------------------------------------
+class Watchdog:
+    # A timer of the main loop updates a heartbeat, which a thread checks.
+    # When the heartbeat is late by more than the threshold, the stack of
+    # the main thread is logged, showing where it is stuck, and the total
+    # duration of the stall is logged once the main loop runs again. Qt runs
+    # the GLib timers too, so this works for the dialer as well
+    heartbeat_fraction = 0.25 # Of the threshold, between heartbeats
+
+    def __init__(self, threshold):
+        self.threshold = threshold # In seconds
+        self.heartbeat_interval = threshold * self.heartbeat_fraction
+        self.main_thread_id = thread.get_ident()
+        self.lock = threading.Lock() # For the heartbeat and stall times
+        self.last_heartbeat = time.time()
+        self.stall_start = None # Set by the thread while stalled
+        self.stall_count = 0
+        self.stall_callbacks = [] # Called from the thread on every stall
+        gobject.timeout_add(
+            int(self.heartbeat_interval * 1000), self.heartbeat)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def heartbeat(self):
+        # Returns true to be used with timeout_add
+        self.lock.acquire()
+        now = time.time()
+        stall_start = self.stall_start
+        self.stall_start = None
+        self.last_heartbeat = now
+        self.lock.release()
+        if stall_start != None:
+            logging.warning("Main loop stalled for %d ms" % (
+                (now - stall_start) * 1000))
+        return True
+
+    def get_main_stack(self):
+        frame = sys._current_frames().get(self.main_thread_id)
+        if frame == None:
+            return "(no stack)"
+        return "".join(traceback.format_stack(frame))
+
+    def run(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            # The heartbeat is expected every heartbeat_interval
+            self.lock.acquire()
+            stall_start = self.last_heartbeat + self.heartbeat_interval
+            late = time.time() - stall_start
+            new_stall = (late > self.threshold and self.stall_start == None)
+            if new_stall:
+                self.stall_start = stall_start
+                self.stall_count += 1
+            self.lock.release()
+            if new_stall:
+                logging.warning(
+                    "Main loop stalled for more than %d ms at:\n%s" % (
+                        late * 1000, self.get_main_stack().rstrip()))
+                for callback in self.stall_callbacks:
+                    callback()
+
+command_line_syntax = "[--watchdog=<msec>]"
+
+def start_watchdog(threshold_msec):
+    # Returns the Watchdog, or None if the threshold is None
+    if threshold_msec == None:
+        return None
+    logging.debug("Watching main loop stalls over %d ms" % threshold_msec)
+    return Watchdog(threshold_msec / 1000.0)
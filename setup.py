@@ -16,5 +16,7 @@ setup(name='opendialer',
       options={'bdist_rpm': {'requires': 'PyQt4',
                              'group':    'User Interface/Desktops',
                              'vendor':   'The OpenDialer Team'}},
-      scripts=['opendialer', 'utils/loopback-loader', 'utils/service-connector']
+      scripts=['opendialer', 'utils/loopback-loader', 'utils/service-connector',
+               'utils/telephony-daemon', 'utils/traffic-replay',
+               'utils/dbus-benchmark']
      )
@@ -0,0 +1,231 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import time
+import unittest
+import testcommon
+import loopbackloader
+from loopbackloader import LoopbackLoader, MockBackend, Loopback, CpuMeter
+
+# Routing logic of the LoopbackLoader against the MockBackend, which
+# replies synchronously, so no sound server and no main loop are needed
+
+class DelayedModuleBackend(MockBackend):
+    # Keeps module-echo-cancel loading until load_pending_module()
+    def load_module(self, module_name, args, reply_handler, error_handler):
+        self.pending_module = (module_name, args, reply_handler, error_handler)
+
+    def load_pending_module(self):
+        MockBackend.load_module(self, *self.pending_module)
+
+class LoopbackLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_profiles = dict(
+            LoopbackLoader.echo_cancel_protocol_profiles)
+        self.backend = MockBackend()
+        self.loader = LoopbackLoader(None, self.backend, monitor_calls=False)
+        self.backend.set_default("sink", "speaker")
+        self.backend.set_default("source", "mic")
+
+    def tearDown(self):
+        LoopbackLoader.echo_cancel_protocol_profiles = self.saved_profiles
+
+    def get_loopbacks(self):
+        return sorted(map(lambda (source, sink, args): (source, sink),
+                          self.backend.loopback_dict.values()))
+
+    def add_headset(self, protocol="sco", address="00:11:22:33:44:55"):
+        return [ self.backend.add_device(
+                     "sink", "bt_sink." + protocol, protocol, address),
+                 self.backend.add_device(
+                     "source", "bt_source." + protocol, protocol, address) ]
+
+    def test_unwanted_modules_unloaded(self):
+        self.assertEqual(self.backend.unloaded_module_names,
+                         LoopbackLoader.unwanted_modules)
+
+    def test_bluetooth_source_to_fallback_sink(self):
+        self.backend.add_device("source", "phone", "a2dp_source", "AA")
+        self.assertEqual(self.get_loopbacks(), [ ("phone", "speaker") ])
+        (source, sink, args) = self.backend.loopback_dict.values()[0]
+        self.assertEqual(args, LoopbackLoader.latency_profiles["a2dp_source"])
+
+    def test_other_devices_ignored(self):
+        self.backend.add_device("source", "usb_mic")
+        self.backend.add_device("source", "phone", "a2dp_sink", "AA")
+        self.assertEqual(self.get_loopbacks(), [])
+
+    def test_device_address_filter(self):
+        backend = MockBackend()
+        loader = LoopbackLoader("AA", backend, monitor_calls=False)
+        backend.set_default("sink", "speaker")
+        backend.add_device("source", "other_phone", "a2dp_source", "BB")
+        backend.add_device("source", "phone", "a2dp_source", "AA")
+        self.assertEqual(
+            map(lambda (source, sink, args): source,
+                backend.loopback_dict.values()), [ "phone" ])
+
+    def test_device_removed(self):
+        device_id = self.backend.add_device(
+            "source", "phone", "a2dp_source", "AA")
+        self.backend.remove_device(device_id)
+        self.assertEqual(self.get_loopbacks(), [])
+        self.assertEqual(self.loader.loopback_dict, dict())
+
+    def test_fallback_change_moves_loopbacks(self):
+        self.backend.add_device("source", "phone", "a2dp_source", "AA")
+        self.backend.set_default("sink", "headphones")
+        self.assertEqual(self.get_loopbacks(), [ ("phone", "headphones") ])
+
+    def test_no_fallback_no_loopback(self):
+        backend = MockBackend()
+        loader = LoopbackLoader(None, backend, monitor_calls=False)
+        backend.add_device("source", "phone", "a2dp_source", "AA")
+        self.assertEqual(backend.loopback_dict, dict())
+        backend.set_default("sink", "speaker")
+        self.assertEqual(len(backend.loopback_dict), 1)
+
+    def test_call_driven_protocols_follow_call(self):
+        self.add_headset("sco")
+        self.assertEqual(self.get_loopbacks(), [])
+        # The metrics are shared by all loaders of the process
+        call_count = self.loader.call_setup_histogram.get_count()
+        self.loader.call_state_changed(True)
+        self.assertEqual(self.get_loopbacks(),
+                         [ ("bt_source.sco", "speaker"),
+                           ("mic", "bt_sink.sco") ])
+        self.assertEqual(self.loader.call_setup_histogram.get_count(),
+                         call_count + 1)
+        self.loader.call_state_changed(False)
+        self.assertEqual(self.get_loopbacks(), [])
+
+    def test_music_kept_during_call(self):
+        self.backend.add_device("source", "phone", "a2dp_source", "AA")
+        self.loader.call_state_changed(True)
+        self.loader.call_state_changed(False)
+        self.assertEqual(self.get_loopbacks(), [ ("phone", "speaker") ])
+
+    def test_failed_load_forgotten(self):
+        self.backend.fail_loads = True
+        self.backend.add_device("source", "phone", "a2dp_source", "AA")
+        self.assertEqual(self.loader.loopback_dict, dict())
+
+    def test_existing_echo_cancel_devices_used(self):
+        self.backend.add_device("sink", "speaker.echo-cancel")
+        self.add_headset("sco")
+        self.loader.call_state_changed(True)
+        self.assertEqual(self.get_loopbacks(),
+                         [ ("bt_source.sco", "speaker.echo-cancel"),
+                           ("mic", "bt_sink.sco") ])
+
+    def test_music_bypasses_echo_cancel(self):
+        self.backend.add_device("sink", "speaker.echo-cancel")
+        self.backend.add_device("source", "phone", "a2dp_source", "AA")
+        self.assertEqual(self.get_loopbacks(), [ ("phone", "speaker") ])
+
+    def test_echo_cancel_around_call(self):
+        LoopbackLoader.echo_cancel_protocol_profiles = { "sco": "light" }
+        self.add_headset("sco")
+        self.loader.call_state_changed(True)
+        ((module_name, args, device_ids),) = self.backend.module_dict.values()
+        self.assertEqual(module_name, "module-echo-cancel")
+        self.assertEqual(args["aec_method"], "speex")
+        self.assertEqual((args["source_master"], args["sink_master"]),
+                         ("mic", "speaker"))
+        self.assertEqual(self.get_loopbacks(),
+                         [ ("bt_source.sco", "opendialer_sink.echo-cancel"),
+                           ("opendialer_source.echo-cancel", "bt_sink.sco") ])
+        self.loader.call_state_changed(False)
+        self.assertEqual(self.backend.module_dict, dict())
+        self.assertEqual(self.get_loopbacks(), [])
+
+    def test_call_audio_waits_for_echo_cancel(self):
+        LoopbackLoader.echo_cancel_protocol_profiles = { "sco": "webrtc" }
+        backend = DelayedModuleBackend()
+        loader = LoopbackLoader(None, backend, monitor_calls=False)
+        backend.set_default("sink", "speaker")
+        backend.set_default("source", "mic")
+        backend.add_device("sink", "bt_sink", "sco", "AA")
+        backend.add_device("source", "bt_source", "sco", "AA")
+        loader.call_state_changed(True)
+        self.assertEqual(backend.loopback_dict, dict())
+        backend.load_pending_module()
+        self.assertEqual(
+            sorted(map(lambda (source, sink, args): (source, sink),
+                       backend.loopback_dict.values())),
+            [ ("bt_source", "opendialer_sink.echo-cancel"),
+              ("opendialer_source.echo-cancel", "bt_sink") ])
+
+    def test_echo_cancel_failure_does_not_block_call(self):
+        LoopbackLoader.echo_cancel_protocol_profiles = { "sco": "light" }
+        backend = DelayedModuleBackend()
+        loader = LoopbackLoader(None, backend, monitor_calls=False)
+        backend.set_default("sink", "speaker")
+        backend.set_default("source", "mic")
+        backend.add_device("sink", "bt_sink", "sco", "AA")
+        loader.call_state_changed(True)
+        backend.pending_module[3]("Mock failure")
+        self.assertEqual(
+            map(lambda (source, sink, args): (source, sink),
+                backend.loopback_dict.values()), [ ("mic", "bt_sink") ])
+
+    def test_latency_sampling(self):
+        self.backend.add_device("source", "phone", "a2dp_source", "AA")
+        loopback = self.loader.loopback_dict.values()[0]
+        self.backend.latency = (20000, 180000)
+        self.assertTrue(self.loader.sample_loopback_latency(loopback))
+        self.assertEqual(loopback.latency_samples, 1)
+        self.assertEqual(loopback.latency_min, 200000)
+        self.backend.remove_device("device1")
+        self.assertFalse(self.loader.sample_loopback_latency(loopback))
+
+class LoopbackTest(unittest.TestCase):
+    def test_latency_statistics(self):
+        loopback = Loopback("a", "b", "sco", { "latency_msec": "40" })
+        for latency in [ (0, 0), (1000, 30000), (2000, 100000) ]:
+            loopback.add_latency_sample(*latency)
+        self.assertEqual(loopback.latency_min, 0)
+        self.assertEqual(loopback.latency_max, 102000)
+        self.assertEqual(loopback.underruns, 1)
+        self.assertEqual(loopback.overruns, 1)
+
+class CpuMeterTest(unittest.TestCase):
+    def test_server_and_own_cpu_time(self):
+        # This process plays the sound server as well
+        meter = CpuMeter()
+        meter.pid = os.getpid()
+        meter.start("test")
+        start_time = time.time()
+        while (meter.get_own_cpu_time() - meter.start_sample[2] < 0.05 and
+               time.time() - start_time < 5):
+            pass
+        meter.stop()
+        self.assertTrue(meter.cpu_counter.get(profile="test") > 0)
+        self.assertTrue(meter.own_cpu_counter.get(profile="test") > 0)
+        self.assertTrue("test: sound server " in meter.describe())
+
+    def test_nothing_without_server(self):
+        meter = CpuMeter()
+        meter.start("test-no-server")
+        meter.stop()
+        self.assertEqual(
+            meter.duration_counter.get(profile="test-no-server"), 0)
+
+if __name__ == "__main__":
+    unittest.main()
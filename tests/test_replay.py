@@ -0,0 +1,145 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import unittest
+import testcommon
+import gobject
+import traffic
+import loopbackloader
+import serviceconnector
+try:
+    from PyQt4 import QtGui
+    import opendialer
+except ImportError:
+    opendialer = None # The dialer part is skipped
+
+# Replays recorded captures as fast as possible through the replay
+# dispatchers, and checks the state each component ends up in
+
+phone_path = "/org/bluez/hci0/dev_00_11_22_33_44_01"
+modem_path = "/hfp" + phone_path
+speaker = "alsa_output.pci-0000_00_1b.0.analog-stereo"
+mic = "alsa_input.pci-0000_00_1b.0.analog-stereo"
+
+def can_show_dialer():
+    return opendialer != None and os.environ.get("DISPLAY")
+
+class ReplayTestCase(unittest.TestCase):
+    def replay(self, capture):
+        self.dispatcher_dict = {
+            "loopback": loopbackloader.create_replay_dispatcher(),
+            "connector": serviceconnector.create_replay_dispatcher() }
+        if can_show_dialer():
+            self.app = (QtGui.QApplication.instance() or
+                        QtGui.QApplication([]))
+            self.dispatcher_dict["dialer"] = (
+                opendialer.create_replay_dispatcher())
+        mainloop = gobject.MainLoop()
+        replayer = traffic.TrafficReplayer(
+            os.path.join(testcommon.capture_path, capture),
+            self.dispatcher_dict, True, mainloop.quit)
+        replayer.start()
+        mainloop.run()
+
+    def get_state(self, component):
+        return self.dispatcher_dict[component].state
+
+class IncomingCallMultipartyTest(ReplayTestCase):
+    # An active incoming call, then a waiting one, answered by holding the
+    # first, after which both are joined into a multiparty call
+    def setUp(self):
+        self.replay("incoming-call-multiparty.jsonl")
+
+    @unittest.skipUnless(can_show_dialer(), "PyQt4 or a display is missing")
+    def test_dialer_shows_multiparty(self):
+        dialog = self.get_state("dialer")["dialog"]
+        state = dialog.get_state()
+        self.assertEqual(state["State"], "active")
+        self.assertTrue(state["Powered"])
+        # One display for the whole multiparty call, the other one free
+        (multiparty_display, free_display) = state["Displays"]
+        self.assertEqual(multiparty_display["Call"],
+                         modem_path + "/voicecall01")
+        self.assertEqual(multiparty_display["State"], "active")
+        self.assertTrue(multiparty_display["Multiparty"])
+        self.assertEqual(free_display["Call"], "")
+        self.assertEqual(free_display["State"], "disconnected")
+        self.assertEqual(len(dialog.call_dict), 2)
+
+    def test_loader_routes_call_and_music(self):
+        loader = self.get_state("loopback")["loader"]
+        self.assertTrue(loader.in_call)
+        self.assertFalse(loader.echo_cancel_pending)
+        loopbacks = dict(map(
+            lambda (key, loopback): (key, loopback.handle),
+            loader.loopback_dict.items()))
+        self.assertEqual(loopbacks, {
+            ("bluez_source.00_11_22_33_44_01.a2dp_source", speaker):
+                "/org/pulseaudio/core1/module27",
+            ("bluez_source.00_11_22_33_44_01.headset_audio_gateway",
+             speaker): "/org/pulseaudio/core1/module28",
+            (mic, "bluez_sink.00_11_22_33_44_01.headset_audio_gateway"):
+                "/org/pulseaudio/core1/module29" })
+
+    def test_connector_has_all_profiles(self):
+        connector = self.get_state("connector")["connector"]
+        self.assertEqual(sorted(connector.path_dict.keys()), [ phone_path ])
+        device_connector = connector.device_connector_dict[
+            "00:11:22:33:44:01"]
+        self.assertEqual(device_connector.device_path, phone_path)
+        self.assertEqual(
+            sorted(device_connector.interface_connector_dict.keys()),
+            [ "org.bluez.AudioSource", "org.bluez.HandsfreeGateway" ])
+        for interface_connector in (
+            device_connector.interface_connector_dict.values()):
+            self.assertFalse(interface_connector.enabled)
+
+class SoundServerRestartTest(ReplayTestCase):
+    # PulseAudio restarts during a call with echo cancellation, taking the
+    # module and the loopbacks with it
+    def setUp(self):
+        self.saved_profiles = dict(
+            loopbackloader.LoopbackLoader.echo_cancel_protocol_profiles)
+        loopbackloader.LoopbackLoader.echo_cancel_protocol_profiles = {
+            "sco": "light" }
+        self.replay("sound-server-restart-in-call.jsonl")
+
+    def tearDown(self):
+        loopbackloader.LoopbackLoader.echo_cancel_protocol_profiles = (
+            self.saved_profiles)
+
+    def test_echo_cancel_reloaded(self):
+        loader = self.get_state("loopback")["loader"]
+        self.assertTrue(loader.in_call)
+        self.assertEqual(loader.echo_cancel_request, "light")
+        self.assertEqual(loader.echo_cancel_handle,
+                         "/org/pulseaudio/core1/module24")
+        self.assertFalse(loader.echo_cancel_pending)
+        loopbacks = dict(map(
+            lambda (key, loopback): (key, loopback.handle),
+            loader.loopback_dict.items()))
+        self.assertEqual(loopbacks, {
+            ("bluez_source.00_11_22_33_44_01.headset_audio_gateway",
+             "opendialer_sink.echo-cancel"): "/org/pulseaudio/core1/module25",
+            ("opendialer_source.echo-cancel",
+             "bluez_sink.00_11_22_33_44_01.headset_audio_gateway"):
+                "/org/pulseaudio/core1/module26" })
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import sys
+import time
+import subprocess
+import distutils.spawn
+import unittest
+import testcommon
+import dbus
+import dbus.mainloop.glib
+import gobject
+from serviceconnector import ServiceConnector, InterfaceConnector, \
+    BluezBackend, Bluez5Backend, ConnectionStats
+
+# The service-connector against utils/fake-bluez, both on a private bus
+
+fake_bluez_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "utils",
+    "fake-bluez")
+phone_address = "00:11:22:33:44:01"
+other_address = "00:11:22:33:44:02"
+profiles = [ "org.bluez.HandsfreeGateway", "org.bluez.AudioSource" ]
+
+class PollCountingBackend(BluezBackend):
+    # Reports nothing by itself, counts the polls of every device path
+    name = "poll-counting"
+
+    def __init__(self):
+        BluezBackend.__init__(self, None)
+        self.poll_count_dict = dict() # Path -> count
+
+    def poll_properties(self, path, interface_names):
+        self.poll_count_dict[path] = self.poll_count_dict.get(path, 0) + 1
+
+class ServiceConnectorTest(unittest.TestCase):
+    def test_device_added_polled_once(self):
+        backend = PollCountingBackend()
+        connector = ServiceConnector(
+            [ phone_address ], 0, backend, ConnectionStats())
+        path = "/org/bluez/hci0/dev_" + phone_address.replace(":", "_")
+        connector.device_added(path, {
+            "Address": phone_address,
+            "Paired": True,
+            "UUIDs": [ "0000111f-0000-1000-8000-00805f9b34fb" ] })
+        self.assertEqual(backend.poll_count_dict, { path: 1 })
+
+def run_until(condition, timeout=5.0):
+    # Runs the main loop until the condition holds, returning it
+    mainloop = gobject.MainLoop()
+    deadline = time.time() + timeout
+    def check():
+        if condition() or time.time() > deadline:
+            mainloop.quit()
+            return False
+        return True
+    gobject.timeout_add(10, check)
+    mainloop.run()
+    return condition()
+
+class FakeBluezTestCase(unittest.TestCase):
+    fake_bluez_args = [ "--connect-delay=0.05", phone_address ]
+
+    def setUp(self):
+        if distutils.spawn.find_executable("dbus-daemon") == None:
+            self.skipTest("dbus-daemon is not installed")
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        saved_delays = (InterfaceConnector.connect_initial_delay,
+                        InterfaceConnector.connect_retry_delay)
+        self.addCleanup(self.restore_delays, saved_delays)
+        InterfaceConnector.connect_initial_delay = 0
+        InterfaceConnector.connect_retry_delay = 0.1
+        # Cleanups run even when the setup fails half way
+        bus_process = self.start_process(
+            [ "dbus-daemon", "--session", "--nofork", "--print-address" ],
+            stdout=subprocess.PIPE)
+        address = bus_process.stdout.readline().strip()
+        environment = dict(os.environ)
+        environment["DBUS_SESSION_BUS_ADDRESS"] = address
+        fake_bluez_process = self.start_process(
+            [ sys.executable, fake_bluez_path, "--session-bus" ] +
+            self.fake_bluez_args, env=environment)
+        self.bus = dbus.bus.BusConnection(address)
+        self.addCleanup(self.bus.close)
+        deadline = time.time() + 5.0
+        while not self.bus.name_has_owner("org.bluez"):
+            self.assertEqual(fake_bluez_process.poll(), None,
+                             "fake-bluez exited")
+            self.assertTrue(time.time() < deadline, "fake-bluez not started")
+            time.sleep(0.02)
+
+    def start_process(self, arguments, **keywords):
+        process = subprocess.Popen(arguments, **keywords)
+        self.addCleanup(self.stop_process, process)
+        return process
+
+    def stop_process(self, process):
+        if process.poll() == None:
+            process.terminate()
+        process.wait()
+
+    def restore_delays(self, saved_delays):
+        (InterfaceConnector.connect_initial_delay,
+         InterfaceConnector.connect_retry_delay) = saved_delays
+
+    def start_connector(self, addresses, max_other_devices=0):
+        self.backend = Bluez5Backend(self.bus)
+        self.stats = ConnectionStats()
+        self.connector = ServiceConnector(
+            addresses, max_other_devices, self.backend, self.stats)
+
+    def get_device_path(self, address):
+        return "/org/bluez/hci0/dev_" + address.replace(":", "_")
+
+    def is_connected(self, address):
+        path = self.get_device_path(address)
+        return len(filter(lambda profile: (path, profile) in (
+            self.backend.connected_profiles), profiles)) == len(profiles)
+
+    def get_control(self):
+        return dbus.Interface(self.bus.get_object("org.bluez", "/"),
+                              "org.opendialer.FakeBluez")
+
+class FakeBluezTest(FakeBluezTestCase):
+    def test_connects_all_profiles(self):
+        self.start_connector([ phone_address ])
+        self.assertTrue(run_until(lambda: self.is_connected(phone_address)))
+        device_connector = self.connector.device_connector_dict[phone_address]
+        self.assertEqual(device_connector.device_path,
+                         self.get_device_path(phone_address))
+        for interface_connector in (
+            device_connector.interface_connector_dict.values()):
+            self.assertFalse(interface_connector.enabled)
+
+    def test_device_added_later(self):
+        self.start_connector([ other_address ])
+        run_until(lambda: False, 0.2)
+        self.assertFalse(self.is_connected(other_address))
+        self.get_control().AddDevice(other_address)
+        self.assertTrue(run_until(lambda: self.is_connected(other_address)))
+
+    def test_reconnects_after_removal(self):
+        self.start_connector([ phone_address ])
+        self.assertTrue(run_until(lambda: self.is_connected(phone_address)))
+        self.get_control().RemoveDevice(phone_address)
+        self.assertTrue(run_until(
+            lambda: not self.is_connected(phone_address)))
+        self.get_control().AddDevice(phone_address)
+        self.assertTrue(run_until(lambda: self.is_connected(phone_address)))
+
+    def test_other_device_picked(self):
+        self.start_connector([], 1)
+        self.assertTrue(run_until(lambda: self.is_connected(phone_address)))
+
+class FailingFakeBluezTest(FakeBluezTestCase):
+    # The first two attempts on the device fail
+    fake_bluez_args = [ "--connect-delay=0.05", "--fail=2", phone_address ]
+
+    def test_retries_until_connected(self):
+        attempts = self.count_attempts()
+        self.start_connector([ phone_address ])
+        self.assertTrue(run_until(
+            lambda: self.is_connected(phone_address), 10.0))
+        self.assertTrue(self.count_attempts() - attempts >= 4)
+
+    def count_attempts(self):
+        # The metrics are shared by all connectors of the process
+        return sum(map(lambda profile: ConnectionStats().attempt_counter.get(
+            interface=profile), profiles))
+
+if __name__ == "__main__":
+    unittest.main()
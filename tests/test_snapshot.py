@@ -0,0 +1,66 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import shutil
+import tempfile
+import unittest
+import testcommon
+from snapshot import CallSnapshot
+
+class CallSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "calls.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, snapshot):
+        CallSnapshot(self.path).save(snapshot)
+
+    def test_round_trip(self):
+        snapshot = { "modem": "/hfp/modem", "calls": [], "displays": [] }
+        self.save(snapshot)
+        self.assertEqual(CallSnapshot(self.path).load("/hfp/modem"), snapshot)
+
+    def test_other_modem_ignored(self):
+        self.save({ "modem": "/hfp/modem", "calls": [] })
+        self.assertEqual(CallSnapshot(self.path).load("/hfp/other"), None)
+
+    def test_any_modem(self):
+        self.save({ "modem": "/hfp/modem", "calls": [] })
+        self.assertEqual(CallSnapshot(self.path).load()["modem"],
+                         "/hfp/modem")
+
+    def test_invalid_snapshot_ignored(self):
+        for text in [ "{", "[]", "{\"modem\": null}" ]:
+            snapshot_file = open(self.path, "w")
+            snapshot_file.write(text)
+            snapshot_file.close()
+            self.assertEqual(CallSnapshot(self.path).load(), None)
+
+    def test_unchanged_not_written(self):
+        call_snapshot = CallSnapshot(self.path)
+        call_snapshot.save({ "modem": "/hfp/modem" })
+        os.remove(self.path)
+        call_snapshot.save({ "modem": "/hfp/modem" })
+        self.assertFalse(os.path.exists(self.path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+#
+#  OpenDialer - Open Source Dialer GUI
+#
+#  Copyright (C) 2011  BMW Car IT GmbH. All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 2 as
+#  published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import os
+import sys
+
+# Shared setup of the tests: the modules of the dialer are imported the way
+# they import each other, from the dialer directory. Run the tests from the
+# top directory with:
+#
+#   python -m unittest discover tests
+
+dialer_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "dialer")
+if dialer_path not in sys.path:
+    sys.path.insert(0, dialer_path)
+
+capture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "captures")